@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+    Benchmarks of the flask_mako render pipeline.
+
+    Every public entry point is measured against generated templates of
+    varying size, inheritance depth, context size and number of blueprints.
+    Run it from the repository root::
+
+        python benchmarks/bench_render.py
+
+    Results can be saved, and later compared to catch regressions between
+    releases; the comparison exits with status 1 if a benchmark got slower
+    than the threshold::
+
+        python benchmarks/bench_render.py --json before.json
+        python benchmarks/bench_render.py --compare before.json
+
+    The peak memory of rendering a large page with every output buffer
+    strategy is shown with::
+
+        python benchmarks/bench_render.py -k buffer --buffer-memory
+
+    On Linux, the private memory of forked workers rendering every template
+    can be compared with and without ``MAKO_PRELOAD``::
+
+        python benchmarks/bench_render.py --fork-memory 4
+"""
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from flask import Flask, Blueprint
+
+import flask_mako
+from flask_mako import (MakoTemplates, TemplateError, render_template,
+                        render_template_string, render_template_def,
+                        render_template_def_many, render_template_text,
+                        buffer_strategy, BUFFER_STRATEGIES)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+PAGE_SIZES = (10, 1000)
+INHERITANCE_DEPTHS = (1, 4, 8)
+CONTEXT_SIZES = (10, 1000)
+BLUEPRINT_COUNTS = (1, 20, 80)
+LARGE_PAGE_ROWS = 20000
+
+
+def write(root, name, text):
+    path = os.path.join(root, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def create_templates(root):
+    """Generates the benchmarked templates in ``root``."""
+    templates = os.path.join(root, 'templates')
+    for size in PAGE_SIZES:
+        write(templates, 'page_%d.html' % size, """
+<table>
+% for row in rows:
+    <tr><td>${row['name']}</td><td>${row['value'] | h}</td></tr>
+% endfor
+</table>
+""")
+    write(templates, 'level_0.html', "<html>${self.body()}</html>")
+    for depth in range(1, max(INHERITANCE_DEPTHS) + 1):
+        write(templates, 'level_%d.html' % depth,
+              '<%%inherit file="level_%d.html"/>\n'
+              '<div class="level-%d">${next.body()}</div>' % (depth - 1,
+                                                             depth))
+        write(templates, 'leaf_%d.html' % depth,
+              '<%%inherit file="level_%d.html"/>\nleaf' % (depth - 1))
+    write(templates, 'defs.html', """
+<%def name="row(item)"><tr><td>${item['name']}</td></tr></%def>
+<table>${row(rows[0])}</table>
+""")
+    write(templates, 'error.html', "${undefined_function()}")
+    for i in range(max(BLUEPRINT_COUNTS)):
+        write(os.path.join(root, 'bp_%d' % i), 'bp_%d.html' % i,
+              "blueprint ${i}")
+    return templates
+
+
+def create_app(root, blueprints=0, **config):
+    app = Flask(__name__, root_path=root)
+    app.config.update(config)
+    for i in range(blueprints):
+        app.register_blueprint(Blueprint('bp_%d' % i, __name__,
+                                         root_path=root,
+                                         template_folder='bp_%d' % i))
+    MakoTemplates(app)
+    return app
+
+
+def rows(count):
+    return [{'name': 'row %d' % i, 'value': '<%d>' % i} for i in range(count)]
+
+
+def benchmarks(root):
+    """Yields ``(name, app, function)`` tuples, ``function`` being called
+    repeatedly in a request context of ``app``."""
+    app = create_app(root)
+    data = rows(1)
+
+    for size in PAGE_SIZES:
+        data = rows(size)
+        yield ('render_template[rows=%d]' % size, app,
+               lambda data=data, size=size: render_template(
+                   'page_%d.html' % size, rows=data))
+
+    yield ('render_template_text[rows=%d]' % size, app,
+           lambda data=data, size=size: render_template_text(
+               'page_%d.html' % size, rows=data))
+
+    large = rows(LARGE_PAGE_ROWS)
+    for strategy in BUFFER_STRATEGIES:
+        def render_large(strategy=strategy):
+            with buffer_strategy(strategy):
+                render_template('page_1000.html', rows=large)
+        yield ('render_template[buffer=%s]' % strategy, app, render_large)
+
+    for depth in INHERITANCE_DEPTHS:
+        yield ('render_template[inheritance=%d]' % depth, app,
+               lambda depth=depth: render_template('leaf_%d.html' % depth))
+
+    for size in CONTEXT_SIZES:
+        context = dict(('var_%d' % i, i) for i in range(size))
+        yield ('render_template[context=%d]' % size, app,
+               lambda context=context: render_template('page_10.html',
+                                                       rows=rows(10),
+                                                       **context))
+
+    items = [{'item': item} for item in rows(100)]
+    yield ('render_template_def[loop=100]', app,
+           lambda: [render_template_def('defs.html', 'row', **context)
+                    for context in items])
+    yield ('render_template_def_many[100]', app,
+           lambda: render_template_def_many('defs.html', 'row', items))
+
+    # dedicated apps, so that the other benchmarks run without processors
+    processed = create_app(root)
+    cached_context = create_app(root, MAKO_CACHE_REQUEST_CONTEXT=True)
+    for app_ in (processed, cached_context):
+        for i in range(5):
+            app_.context_processor(lambda i=i: {'processed_%d' % i: i})
+    yield ('render_template_def[processors=5]', processed,
+           lambda: render_template_def('defs.html', 'row', item=data[0]))
+    yield ('render_template_def[processors=5,cached]', cached_context,
+           lambda: render_template_def('defs.html', 'row', item=data[0]))
+
+    source = u"<p>${title}</p>" * 20
+    yield ('render_template_string[cached]', app,
+           lambda: render_template_string(source, title='title'))
+    uncached = create_app(root, MAKO_STRING_CACHE_SIZE=0)
+    yield ('render_template_string[uncached]', uncached,
+           lambda: render_template_string(source, title='title'))
+
+    yield ('render_template_def', app,
+           lambda: render_template_def('defs.html', 'row', item=data[0]))
+
+    for count in BLUEPRINT_COUNTS:
+        bp_app = create_app(root, blueprints=count)
+        yield ('create_lookup[blueprints=%d]' % count, bp_app,
+               lambda bp_app=bp_app: flask_mako._create_lookup(bp_app))
+
+        def first_render(bp_app=bp_app, count=count):
+            bp_app._mako_lookup = None
+            render_template('bp_%d.html' % (count - 1), i=count)
+        yield ('first_render[blueprints=%d]' % count, bp_app, first_render)
+
+    def translated_error():
+        try:
+            render_template('error.html')
+        except TemplateError:
+            pass
+    yield ('render_template[error]', app, translated_error)
+
+
+def percentile(samples, percent):
+    index = int(round(percent / 100.0 * (len(samples) - 1)))
+    return samples[index]
+
+
+def measure(app, function, iterations, warmup):
+    with app.test_request_context():
+        for _ in range(warmup):
+            function()
+        samples = []
+        for _ in range(iterations):
+            start = clock()
+            function()
+            samples.append(clock() - start)
+    samples.sort()
+    total = sum(samples)
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / total if total else float('inf'),
+        'mean': total / iterations,
+        'p50': percentile(samples, 50),
+        'p99': percentile(samples, 99),
+    }
+
+
+def format_time(seconds):
+    if seconds < 1e-3:
+        return '%7.1fus' % (seconds * 1e6)
+    return '%7.2fms' % (seconds * 1e3)
+
+
+def run(args):
+    root = tempfile.mkdtemp()
+    results = {}
+    try:
+        create_templates(root)
+        print('%-40s %12s %10s %10s %10s' % ('benchmark', 'ops/s', 'mean',
+                                             'p50', 'p99'))
+        for name, app, function in benchmarks(root):
+            if args.filter and args.filter not in name:
+                continue
+            result = measure(app, function, args.iterations, args.warmup)
+            results[name] = result
+            print('%-40s %12.1f %s %s %s' % (
+                name, result['ops_per_sec'], format_time(result['mean']),
+                format_time(result['p50']), format_time(result['p99'])))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def buffer_memory():
+    """Prints the peak memory allocated while rendering a large page with
+    every buffer strategy."""
+    try:
+        import tracemalloc
+    except ImportError:
+        print('Measuring buffer memory requires tracemalloc.')
+        return
+    root = tempfile.mkdtemp()
+    try:
+        create_templates(root)
+        app = create_app(root)
+        data = rows(LARGE_PAGE_ROWS)
+        print()
+        print('%-40s %12s %12s' % ('buffer strategy', 'peak MiB',
+                                   'output MiB'))
+        with app.test_request_context():
+            render_template('page_1000.html', rows=rows(1))
+            for strategy in BUFFER_STRATEGIES:
+                tracemalloc.start()
+                with buffer_strategy(strategy):
+                    output = render_template('page_1000.html', rows=data)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print('%-40s %12.2f %12.2f' % (strategy, peak / 2.0 ** 20,
+                                               len(output) / 2.0 ** 20))
+                del output
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def private_memory():
+    """Returns the private memory of the current process in bytes, or `None`
+    when it can't be read from /proc."""
+    for name in ('/proc/self/smaps_rollup', '/proc/self/smaps'):
+        try:
+            with open(name) as f:
+                lines = f.readlines()
+        except IOError:
+            continue
+        return sum(int(line.split()[1]) * 1024 for line in lines
+                   if line.startswith(('Private_Clean:', 'Private_Dirty:')))
+    return None
+
+
+def render_all(app):
+    directories = flask_mako._template_directories(app)
+    with app.test_request_context():
+        for uri, _ in flask_mako._iter_templates(directories):
+            try:
+                render_template(uri, rows=rows(10), i=0)
+            except TemplateError:
+                pass
+
+
+def worker_memory(app, workers):
+    """Forks ``workers`` processes rendering every template, and returns
+    their mean private memory."""
+    sizes = []
+    for _ in range(workers):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            render_all(app)
+            os.write(write, str(private_memory()).encode('ascii'))
+            os._exit(0)
+        os.close(write)
+        with os.fdopen(read) as f:
+            sizes.append(int(f.read()))
+        os.waitpid(pid, 0)
+    return sum(sizes) / float(len(sizes))
+
+
+def fork_memory(workers):
+    """Prints the private memory of forked workers with lazily loaded and
+    with preloaded templates."""
+    if not hasattr(os, 'fork') or private_memory() is None:
+        print('Measuring worker memory requires fork() and /proc.')
+        return
+    root = tempfile.mkdtemp()
+    try:
+        create_templates(root)
+        blueprints = max(BLUEPRINT_COUNTS)
+        lazy = worker_memory(create_app(root, blueprints), workers)
+        preloaded = worker_memory(
+            create_app(root, blueprints, MAKO_PRELOAD=True), workers)
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    saving = lazy - preloaded
+    print()
+    print('%-40s %12s' % ('private memory per worker', 'MiB'))
+    print('%-40s %12.2f' % ('lazy', lazy / 2.0 ** 20))
+    print('%-40s %12.2f' % ('MAKO_PRELOAD', preloaded / 2.0 ** 20))
+    print('%-40s %12.2f' % ('saved per worker', saving / 2.0 ** 20))
+    print('%-40s %12.2f' % ('saved for %d workers' % workers,
+                            saving * workers / 2.0 ** 20))
+
+
+def compare(results, baseline, threshold):
+    """Prints the relative change of every benchmark against the baseline
+    and returns the names of the ones that regressed."""
+    regressions = []
+    print()
+    print('%-40s %10s %10s %8s' % ('benchmark', 'before', 'after', 'change'))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['mean'], result['mean']
+        change = (after - before) / before * 100.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-40s %s %s %+7.1f%%%s' % (name, format_time(before),
+                                          format_time(after), change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', '-n', type=int, default=200,
+                        help='timed calls per benchmark (default: 200)')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='untimed calls per benchmark (default: 10)')
+    parser.add_argument('--filter', '-k',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--json', metavar='FILE',
+                        help='save the results to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results to those saved in FILE')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='slowdown in percent reported as a regression '
+                             '(default: 10)')
+    parser.add_argument('--buffer-memory', action='store_true',
+                        help='also measure the peak memory of every output '
+                             'buffer strategy')
+    parser.add_argument('--fork-memory', type=int, metavar='WORKERS',
+                        help='also measure the memory of WORKERS forked '
+                             'workers, with and without MAKO_PRELOAD')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.buffer_memory:
+        buffer_memory()
+    if args.fork_memory:
+        fork_memory(args.fork_memory)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,9 +10,30 @@
     :license: BSD, see LICENSE for more details.
 """
 import os, sys
+import errno
+import functools
+import gc
+import posixpath
+import hashlib
+import io
+import copy
+import itertools
+import marshal
+import mmap
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import types
+import zlib
+from collections import deque, namedtuple, OrderedDict
+from contextlib import contextmanager
 
+from flask import (current_app, request, _request_ctx_stack,
+                   stream_with_context)
 from flask.helpers import locked_cached_property
-from flask.signals import template_rendered
+from flask.signals import Namespace, template_rendered
 
 # Find the context stack so we can resolve which application is calling this
 # extension.  Starting with Flask 0.9, the _app_ctx_stack is the correct one,
@@ -22,20 +43,101 @@ try:
 except ImportError:
     from flask import _request_ctx_stack as stack
 
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+try:
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = ThreadPoolExecutor = None
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+# The command line interface only exists since Flask 0.11.
+try:
+    import click
+    from flask.cli import AppGroup
+except ImportError:
+    click = None
+
 from werkzeug.debug.tbtools import Traceback, Frame, Line
 
 from mako.lookup import TemplateLookup
-from mako.template import Template
-from mako import exceptions
-from mako.exceptions import RichTraceback, text_error_template
+from mako.template import Template, DefTemplate, ModuleInfo
+from mako.lexer import Lexer
+from mako.parsetree import InheritTag, IncludeTag, NamespaceTag
+from mako.template import _compile as _compile_mako, _get_module_info
+from mako import codegen, exceptions, runtime, util
+from mako.exceptions import (RichTraceback, CompileException, SyntaxException,
+                             text_error_template)
 
 
 itervalues = getattr(dict, 'itervalues', dict.values)
 
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+CompileInfo = namedtuple('CompileInfo', 'compiled duplicates_avoided')
+
+_FragmentPolicy = namedtuple('_FragmentPolicy', 'key timeout')
+
+_replace_file = getattr(os, 'replace', os.rename)
+
 _BABEL_IMPORTS =  'from flask.ext.babel import gettext as _, ngettext, ' \
                   'pgettext, npgettext'
 _FLASK_IMPORTS =  'from flask.helpers import url_for, get_flashed_messages'
 
+# Number of chunks a streamed template may render ahead of its consumer.
+_STREAM_QUEUE_SIZE = 4
+
+# Number of render durations kept per template to compute percentiles.
+_STATS_SAMPLES = 1000
+
+_signals = Namespace()
+
+#: Sent before a template is rendered, with the ``template`` and the
+#: ``context``.
+before_render = _signals.signal('mako-before-render')
+
+#: Sent after a template is rendered, with the ``template``, the ``context``
+#: and the render ``duration`` in seconds.
+after_render = _signals.signal('mako-after-render')
+
+
+def _has_receivers(signal):
+    # signals are no-ops without blinker, and then have no receivers
+    return bool(getattr(signal, 'receivers', None))
+
+
+_NO_SIGNALS = (False, False, False)
+
+
+def _signals_to_send(app):
+    """Returns whether the before_render, after_render and template_rendered
+    signals are to be sent for the current render: only when they have
+    receivers, and with ``MAKO_SIGNAL_SAMPLE_RATE`` only for one render in
+    that many."""
+    signals = (_has_receivers(before_render), _has_receivers(after_render),
+               _has_receivers(template_rendered))
+    if signals == _NO_SIGNALS:
+        return signals
+    rate = app.config['MAKO_SIGNAL_SAMPLE_RATE']
+    if rate > 1 and next(app._mako_render_count) % rate:
+        return _NO_SIGNALS
+    return signals
+
+
+def _template_key(template):
+    """Returns the ``(uri, def_name)`` of a template, ``def_name`` being
+    `None` unless the template renders a def."""
+    if isinstance(template, DefTemplate):
+        return (template.parent.uri,
+                template.callable_.__name__[len('render_'):])
+    return template.uri, None
+
 class MakoFrame(Frame):
     """ A special `~werkzeug.debug.tbtools.Frame` object for Mako sources. """
     def __init__(self, exc_type, exc_value, tb, name, line):
@@ -66,7 +168,16 @@ class MakoFrame(Frame):
 
 
 class TemplateError(RichTraceback, RuntimeError):
-    """ A template has thrown an error during rendering. """
+    """ A template has thrown an error during rendering.
+
+    The Mako traceback translation is only done when :attr:`records`,
+    :attr:`text` or the Werkzeug debugger first need it, so that errors which
+    are never inspected stay cheap to raise.
+    """
+
+    #: When errors are summarized, the number of identical errors raised
+    #: before this one during the current summary interval.
+    repeated = 0
 
     def werkzeug_debug_traceback(self, exc_type, exc_value, tb):
         """ Munge the default Werkzeug traceback to include Mako info. """
@@ -97,186 +208,2826 @@ class TemplateError(RichTraceback, RuntimeError):
         return translated
 
 
-    def __init__(self, template):
-        super(TemplateError, self).__init__()
+    def __init__(self, template, summary=None):
         self.einfo = sys.exc_info()
-        self.text = text_error_template().render()
+        self.error = self.einfo[1]
+        self.template_uri = _template_key(template)[0]
         msg = "Error occurred while rendering template '{0}'"
-        msg = msg.format(template.uri)
-        super(TemplateError, self).__init__(msg)
+        self.message = msg.format(self.template_uri)
+        self._summary = summary
+        if summary is not None:
+            summary.count(self)
+        RuntimeError.__init__(self, self.message)
+
+    def __getattr__(self, name):
+        # only called for the attributes that have not been computed yet
+        if name in ('records', 'source', 'lineno'):
+            self._translate()
+        elif name == 'text':
+            if self._summary is not None:
+                self.text = self._summary.text_for(self)
+            else:
+                self.text = self.render_text()
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
 
+    def _translate(self):
+        self.source, self.lineno = "", 0
+        self.records = self._init(self.einfo[2])
+        if isinstance(self.error, (CompileException, SyntaxException)):
+            self.source = self.error.source
+            self.lineno = self.error.lineno
 
-class MakoTemplates(object):
-    """
-    Main class for bridging mako and flask. We try to stay as close as possible
-    to how Jinja2 is used in Flask, while at the same time surfacing the useful
-    stuff from Mako.
+    def render_text(self):
+        """Renders the translated traceback with :func:`text_error_template
+        <mako.exceptions.text_error_template>`."""
+        return text_error_template().render(error=self.error,
+                                            traceback=self.einfo[2])
+
+    def error_key(self):
+        """Identifies identical errors: the template, exception type and
+        location the exception was raised from."""
+        tb = self.einfo[2]
+        while tb is not None and tb.tb_next is not None:
+            tb = tb.tb_next
+        location = (tb.tb_frame.f_code.co_filename, tb.tb_lineno) if tb \
+            else None
+        return self.template_uri, self.einfo[0], location
 
+
+class ErrorSummary(object):
     """
+    Summarizes repeated identical :class:`TemplateError`, so that an error
+    storm renders the traceback text once per ``interval`` seconds instead of
+    once per error. Errors sharing a :meth:`~TemplateError.error_key` within
+    the interval share the same text and count their repeats.
 
-    def __init__(self, app=None):
-        self.app = None
-        if app is not None:
-            self.init_app(app)
-        self.app = app
+    """
 
+    #: The maximum number of distinct errors tracked at once.
+    max_entries = 1000
 
-    def init_app(self, app):
-        """
-        Initialize a :class:`~flask.Flask` application
-        for use with this extension. This method is useful for the factory
-        pattern of extension initialization. Example::
+    def __init__(self, interval):
+        self.interval = interval
+        self._entries = {}
+        self._lock = threading.Lock()
 
-            mako = MakoTemplates()
+    def _entry(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and now - entry[0] >= self.interval:
+            entry = None
+        if entry is None:
+            if len(self._entries) >= self.max_entries:
+                self._entries = dict(
+                    (k, e) for k, e in self._entries.items()
+                    if now - e[0] < self.interval)
+            # [interval start, occurrences, text]
+            entry = self._entries[key] = [now, 0, None]
+        return entry
 
-            app = Flask(__name__)
-            mako.init_app(app)
+    def count(self, error):
+        """Records an occurrence of the given error."""
+        with self._lock:
+            entry = self._entry(error.error_key(), time.time())
+            error.repeated = entry[1]
+            entry[1] += 1
 
-        .. note::
-            This call will fail if you called the :class:`MakoTemplates`
-            constructor with an ``app`` argument.
+    def text_for(self, error):
+        """Returns the text of the given error, rendering it only if it is
+        the first of its kind in the current interval."""
+        key = error.error_key()
+        with self._lock:
+            text = self._entry(key, time.time())[2]
+        if text is None:
+            text = error.render_text()
+            with self._lock:
+                self._entry(key, time.time())[2] = text
+        return text
 
-        """
-        if self.app:
-            raise RuntimeError("Cannot call init_app when app argument was "
-                               "provided to MakoTemplates constructor.")
+    def summaries(self):
+        """Returns ``(key, occurrences)`` tuples for the errors of the current
+        intervals, the most frequent first."""
+        now = time.time()
+        with self._lock:
+            counts = [(key, entry[1]) for key, entry in self._entries.items()
+                      if now - entry[0] < self.interval]
+        return sorted(counts, key=lambda item: -item[1])
 
-        if not hasattr(app, 'extensions'):
-            app.extensions = {}
 
-        app.extensions['mako'] = self
-        app._mako_lookup = None
+def _code_digest(code):
+    """Returns a hash of what a code object does, including the code objects
+    it defines, but not the file and line it comes from."""
+    digest = hashlib.sha1(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            const = _code_digest(const)
+        digest.update(repr(const).encode('utf-8'))
+    digest.update(repr(code.co_names).encode('utf-8'))
+    return digest.hexdigest()
 
-        app.config.setdefault('MAKO_INPUT_ENCODING', 'utf-8')
-        app.config.setdefault('MAKO_OUTPUT_ENCODING', 'utf-8')
-        app.config.setdefault('MAKO_MODULE_DIRECTORY', None)
-        app.config.setdefault('MAKO_COLLECTION_SIZE', -1)
-        app.config.setdefault('MAKO_IMPORTS', None)
-        app.config.setdefault('MAKO_FILESYSTEM_CHECKS', True)
-        app.config.setdefault('MAKO_TRANSLATE_EXCEPTIONS', True)
-        app.config.setdefault('MAKO_DEFAULT_FILTERS', None)
-        app.config.setdefault('MAKO_PREPROCESSOR', None)
-        app.config.setdefault('MAKO_STRICT_UNDEFINED', False)
 
+class BytecodeCache(object):
+    """
+    A content-addressed cache of compiled template code objects, shared by
+    all the processes using the same ``directory``. Entries are keyed on the
+    template source and on the options affecting the generated code, so
+    they never need to be invalidated, and are written to a temporary file
+    first, then moved in place, so that concurrent writers are safe.
 
-def _create_lookup(app):
-    """Returns a :class:`TemplateLookup <mako.lookup.TemplateLookup>`
-    instance that looks for templates from the same places as Flask, ie.
-    subfolders named 'templates' in both the app folder and its blueprints'
-    folders.
+    Functions given as options, such as a preprocessor, are keyed on their
+    code and on the values of their closure, so that changing their body
+    changes the key. Other callables, such as classes, are only keyed on
+    their name: the cache directory must be cleared when they change.
 
-    If flask-babel is installed it will add support for it in the templates
-    by adding the appropriate imports clause.
+    Entries are read through memory-mapped files, which saves nothing over
+    reading them, as :func:`marshal.loads` copies the data anyway.
 
     """
-    imports = app.config['MAKO_IMPORTS'] or []
-    imports.append(_FLASK_IMPORTS)
 
-    if 'babel' in app.extensions:
-        imports.append(_BABEL_IMPORTS)
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
 
-    # for beaker
-    cache_impl = app.config.get('MAKO_CACHE_IMPL')
-    cache_args = app.config.get('MAKO_CACHE_ARGS')
+    @staticmethod
+    def _describe(option):
+        if isinstance(option, (list, tuple)):
+            return [BytecodeCache._describe(o) for o in option]
+        if isinstance(option, functools.partial):
+            return [BytecodeCache._describe(option.func),
+                    BytecodeCache._describe(list(option.args)),
+                    sorted((option.keywords or {}).items())]
+        function = getattr(option, '__func__', option)
+        code = getattr(function, '__code__', None)
+        if code is not None:
+            cells = getattr(function, '__closure__', None) or ()
+            closure = [cell.cell_contents for cell in cells]
+            return [_code_digest(code), BytecodeCache._describe(closure)]
+        if callable(option):
+            return '{0}.{1}'.format(getattr(option, '__module__', None),
+                                    getattr(option, '__name__', None))
+        return option
 
-    kw = {
-        'input_encoding': app.config['MAKO_INPUT_ENCODING'],
-        'output_encoding': app.config['MAKO_OUTPUT_ENCODING'],
-        'module_directory': app.config['MAKO_MODULE_DIRECTORY'],
-        'collection_size': app.config['MAKO_COLLECTION_SIZE'],
-        'imports': imports,
-        'filesystem_checks': app.config['MAKO_FILESYSTEM_CHECKS'],
-        'default_filters': app.config['MAKO_DEFAULT_FILTERS'],
-        'preprocessor': app.config['MAKO_PREPROCESSOR'],
-        'strict_undefined': app.config['MAKO_STRICT_UNDEFINED'],
-    }
+    def key_for(self, template, filename, source):
+        """Returns the cache key of a template given its file and source."""
+        options = [template.uri, filename, template.module_id,
+                   template.input_encoding, template.default_filters,
+                   template.buffer_filters, template.imports,
+                   template.future_imports, template.strict_undefined,
+                   template.enable_loop, template.preprocessor,
+                   template.lexer_cls, codegen.MAGIC_NUMBER, sys.version]
+        digest = hashlib.sha1(repr(self._describe(options)).encode('utf-8'))
+        digest.update(source)
+        return digest.hexdigest()
 
-    if cache_impl:
-        kw['cache_impl'] = cache_impl
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.bin')
 
-    if cache_args:
-        kw['cache_args'] = cache_args
+    def load(self, key):
+        """Returns the ``(module_source, code, dependencies)`` tuple cached
+        under ``key``, or `None`."""
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    entry = marshal.loads(data)
+                finally:
+                    data.close()
+        except (IOError, OSError, ValueError, EOFError, TypeError):
+            return None
+        if not isinstance(entry, tuple) or len(entry) != 3:
+            # written by a previous version
+            return None
+        return entry
 
-    if isinstance(app.template_folder, (list, tuple)):
-        paths = [os.path.join(app.root_path, tf) for tf in app.template_folder]
-    else:
-        paths = [os.path.join(app.root_path, app.template_folder)]
-    blueprints = getattr(app, 'blueprints', {})
-    for blueprint in itervalues(blueprints):
-        bp_tf = blueprint.template_folder
-        if bp_tf:
-            if isinstance(bp_tf, (list, tuple)):
-                paths.extend([os.path.join(blueprint.root_path, tf)
-                              for tf in bp_tf])
-            else:
-                paths.append(os.path.join(blueprint.root_path, bp_tf))
-    paths = [path for path in paths if os.path.isdir(path)]
-    return TemplateLookup(directories=paths, **kw)
+    def store(self, key, module_source, code, dependencies=None):
+        """Caches the generated module source and its code object, along
+        with the names of the templates the template depends on, if known,
+        so that it doesn't have to be parsed again to find them."""
+        if dependencies is not None:
+            dependencies = tuple(dependencies)
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(marshal.dumps((module_source, code, dependencies)))
+        _replace_file(tmp, self._path(key))
 
 
-def _lookup(app):
-    if not app._mako_lookup:
-        app._mako_lookup = _create_lookup(app)
-    return app._mako_lookup
+class _BytecodeTemplate(Template):
+    """A template which gets its code from :attr:`bytecode_cache` if set,
+    instead of compiling it or loading it from the module directory."""
 
+    bytecode_cache = None
 
-def _render(template, context, app):
-    """Renders the template and fires the signal"""
-    context.update(app.jinja_env.globals)
-    app.update_template_context(context)
-    try:
-        rv = template.render(**context)
-        template_rendered.send(app, template=template, context=context)
-        return rv
-    except:
-        translate = app.config.get("MAKO_TRANSLATE_EXCEPTIONS")
-        if translate:
-            translated = TemplateError(template)
-            raise translated
+    def _compile_from_file(self, path, filename):
+        cache = self.bytecode_cache
+        if cache is None:
+            return super(_BytecodeTemplate, self)._compile_from_file(
+                path, filename)
+
+        data = util.read_file(filename)
+        key = cache.key_for(self, filename, data)
+        entry = cache.load(key)
+        if entry is None:
+            module_source = _compile_mako(self, data, filename, False)[0]
+            code = compile(module_source, self.module_id, 'exec')
+            cache.store(key, module_source, code, _lexed.dependencies)
         else:
-            raise
+            module_source, code, dependencies = entry
+            if dependencies is not None:
+                _lexed.dependencies = list(dependencies)
 
+        module = types.ModuleType(self.module_id)
+        exec(code, module.__dict__, module.__dict__)
+        # the code may have been generated before the file was last touched
+        module._modified_time = max(module._modified_time,
+                                    os.stat(filename).st_mtime)
+        self._source = None
+        self._code = module_source
+        ModuleInfo(module, None, self, filename, module_source, None, None)
+        return module
 
-def render_template(template_name, **context):
-    """Renders a template from the template folder with the given
-    context.
 
-    :param template_name: the name of the template to be rendered
-    :param context: the variables that should be available in the
-                    context of the template.
+def _normalize_uri(uri):
+    return posixpath.normpath(uri.replace('\\', '/').lstrip('/'))
+
+
+def _node_dependencies(node):
+    """Returns the files a parsed template inherits from, includes or
+    imports as namespaces, except for those given by an expression."""
+    found = []
+    for child in node.get_children():
+        if isinstance(child, (InheritTag, IncludeTag, NamespaceTag)):
+            filename = child.attributes.get('file')
+            if filename and '${' not in filename:
+                found.append(filename)
+        found.extend(_node_dependencies(child))
+    return found
+
+
+# the dependencies found by _RecordingLexer for the template being compiled
+# by the current thread
+_lexed = threading.local()
+
+
+class _RecordingLexer(Lexer):
+    """Records the dependencies of the templates it parses, so that they
+    don't have to be parsed again to build the :class:`DependencyGraph`."""
+
+    def parse(self):
+        node = super(_RecordingLexer, self).parse()
+        _lexed.dependencies = _node_dependencies(node)
+        return node
+
+
+class DependencyGraph(object):
     """
-    ctx = stack.top
-    return _render(_lookup(ctx.app).get_template(template_name),
-                   context, ctx.app)
+    Records the templates each compiled template inherits from, includes or
+    imports as a namespace. Template uris are normalized, without a leading
+    slash. Dependencies given by an expression are only known when rendering
+    and aren't recorded.
 
+    """
 
-def render_template_string(source, **context):
-    """Renders a template from the given template source string
-    with the given context.
+    def __init__(self):
+        self._dependencies = {}
+        self._dependents = {}
+        self._lock = threading.Lock()
 
-    :param source: the sourcecode of the template to be
-                          rendered
-    :param context: the variables that should be available in the
-                    context of the template.
+    def add(self, uri, dependencies):
+        """Sets the dependencies of the template ``uri``."""
+        with self._lock:
+            for dependency in self._dependencies.get(uri, ()):
+                self._dependents[dependency].discard(uri)
+            self._dependencies[uri] = frozenset(dependencies)
+            for dependency in dependencies:
+                self._dependents.setdefault(dependency, set()).add(uri)
+
+    def __contains__(self, uri):
+        return uri in self._dependencies
+
+    def dependencies(self, uri):
+        """Returns the uris of the templates ``uri`` directly depends on."""
+        return self._dependencies.get(uri, frozenset())
+
+    def dependents(self, uri, recursive=True):
+        """Returns the uris of the templates depending on ``uri``, directly or,
+        when ``recursive`` is true, through other templates."""
+        found = set()
+        pending = [uri]
+        with self._lock:
+            while pending:
+                for dependent in self._dependents.get(pending.pop(), ()):
+                    if dependent not in found:
+                        found.add(dependent)
+                        if recursive:
+                            pending.append(dependent)
+        found.discard(uri)
+        return found
+
+    def as_dict(self):
+        """Returns a dictionary mapping each template uri to the sorted list
+        of its direct dependencies."""
+        with self._lock:
+            return dict((uri, sorted(dependencies))
+                        for uri, dependencies in self._dependencies.items())
+
+
+def _code_size(code):
+    size = sys.getsizeof(code) + sys.getsizeof(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            size += _code_size(const)
+        else:
+            size += sys.getsizeof(const)
+    return size
+
+
+def template_footprint(template):
     """
-    ctx = stack.top
-    template = Template(source, lookup=_lookup(ctx.app))
-    return _render(template, context, ctx.app)
+    Returns an estimate of the memory used by a compiled template, in bytes:
+    its generated module source and template source, the code of the
+    functions of its module, and the module and template namespaces. Objects
+    shared with other templates, such as imported names, aren't counted.
 
+    """
+    module = template.module
+    size = sys.getsizeof(template.__dict__) + sys.getsizeof(module.__dict__)
+    sources = set()
+    info = getattr(template, '_mmarker', None)
+    for source in (template._code, template._source,
+                   getattr(info, 'module_source', None),
+                   getattr(info, 'template_source', None),
+                   getattr(info, 'compressed', None)):
+        if source is not None and id(source) not in sources:
+            sources.add(id(source))
+            size += sys.getsizeof(source)
+    for value in list(module.__dict__.values()):
+        code = getattr(value, '__code__', None)
+        if (isinstance(code, types.CodeType) and
+                getattr(value, '__module__', None) == module.__name__):
+            size += _code_size(code)
+    return size
 
-def render_template_def(template_name, def_name, **context):
-    """Renders a specific def from a given
-    template from the template folder with the given
-    context. Useful for implementing this AJAX pattern:
 
-    http://techspot.zzzeek.org/2008/09/01/ajax-the-mako-way
+class SizedTemplateCollection(object):
+    """
+    A thread-safe LRU mapping of compiled templates bounded by their
+    estimated memory footprint instead of their number. When the templates
+    use more than ``max_bytes``, the least recently used ones are dropped,
+    and compiled again when next used. The last template added is always
+    kept, even when it is larger than ``max_bytes`` on its own.
 
-    :param template_name: the name of the template file containing the def
-                    to be rendered
-    :param def_name: the name of the def to be rendered
-    :param context: the variables that should be available in the
-                    context of the template.
     """
-    ctx = stack.top
-    template = _lookup(ctx.app).get_template(template_name)
-    return _render(template.get_def(def_name), context, ctx.app)
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.currsize = 0
+        self.evictions = 0
+        self._templates = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, uri):
+        with self._lock:
+            template = self._templates.pop(uri)
+            self._templates[uri] = template
+            return template
+
+    def get(self, uri, default=None):
+        try:
+            return self[uri]
+        except KeyError:
+            return default
+
+    def __setitem__(self, uri, template):
+        size = template_footprint(template)
+        with self._lock:
+            if uri in self._templates:
+                del self._templates[uri]
+                self.currsize -= self._sizes.pop(uri)
+            self._templates[uri] = template
+            self._sizes[uri] = size
+            self.currsize += size
+            while self.currsize > self.max_bytes and len(self._templates) > 1:
+                evicted = next(iter(self._templates))
+                del self._templates[evicted]
+                self.currsize -= self._sizes.pop(evicted)
+                self.evictions += 1
+
+    def __contains__(self, uri):
+        return uri in self._templates
+
+    def __len__(self):
+        return len(self._templates)
+
+    def keys(self):
+        with self._lock:
+            return list(self._templates)
+
+    def pop(self, uri, *default):
+        with self._lock:
+            if uri in self._templates:
+                self.currsize -= self._sizes.pop(uri)
+            return self._templates.pop(uri, *default)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self._sizes.clear()
+            self.currsize = 0
+
+    def sizes(self):
+        """Returns ``(uri, size)`` tuples for the templates, from the most to
+        the least recently used."""
+        with self._lock:
+            return [(uri, self._sizes[uri])
+                    for uri in reversed(list(self._templates))]
+
+
+class MakoTemplateLookup(TemplateLookup):
+    """
+    The :class:`~mako.lookup.TemplateLookup` used by the extension. It
+    reports the compile time of templates to :attr:`stats` when set, and
+    can check template files for changes less often than on every
+    :meth:`get_template` call.
+
+    With ``collection_max_bytes``, compiled templates are kept in a
+    :class:`SizedTemplateCollection` bounded by their memory footprint
+    rather than by ``collection_size``.
+
+    Once :meth:`build_index` is called, templates are found with a single
+    lookup in an index of the template directories, instead of probing
+    every directory in turn. When filesystem checks are disabled, the index
+    is authoritative for the names it covers, which excludes hidden files.
+    Otherwise a template missing from the index builds it again if one of
+    the indexed directories was modified, at most once per
+    :attr:`check_interval`, and a template found in the index is still
+    looked for in the directories searched before its own.
+
+    """
+
+    #: The :class:`RenderStats` compile times are recorded in, if any.
+    stats = None
+
+    #: When filesystem checks are enabled, the minimum number of seconds
+    #: between two checks of the same template file. 0 checks every time.
+    check_interval = 0
+
+    #: The :class:`BytecodeCache` templates are loaded from, if any.
+    bytecode_cache = None
+
+    #: Called with the set of the uris of the templates dropped by
+    #: :meth:`invalidate` or because a file changed, or with `None` when all
+    #: templates were dropped.
+    on_invalidate = None
+
+    def __init__(self, *args, **kwargs):
+        max_bytes = kwargs.pop('collection_max_bytes', None)
+        super(MakoTemplateLookup, self).__init__(*args, **kwargs)
+        if max_bytes:
+            self._collection = SizedTemplateCollection(max_bytes)
+        self._next_checks = {}
+        self._compile_locks = {}
+        self.compiled = 0
+        self.duplicates_avoided = 0
+        self.index = None
+        self.shadowed = {}
+        self._index_positions = {}
+        self._index_mtimes = {}
+        self._next_index_check = 0
+        self._dependencies = DependencyGraph()
+        self._unparsed = {}
+        self._parse_lock = threading.Lock()
+        self._digests = {}
+
+    def build_index(self):
+        """
+        Indexes the files of the template directories. Afterwards,
+        :attr:`index` maps template uris to file names and :attr:`shadowed`
+        maps the uris found in several directories to the list of their
+        files, the first of which is used.
+
+        """
+        # taken first, so that files added while indexing trigger a rebuild
+        mtimes = _directory_mtimes(self.directories)
+        index = {}
+        shadowed = {}
+        positions = {}
+        for position, directory in enumerate(self.directories):
+            for uri, filename in _iter_templates([directory]):
+                if uri in index:
+                    shadowed.setdefault(uri, [index[uri]]).append(filename)
+                else:
+                    index[uri] = filename
+                    positions[uri] = position
+        self._index_positions = positions
+        self.index, self.shadowed = index, shadowed
+        self._index_mtimes = mtimes
+
+    def _refresh_index(self):
+        """Builds the index again if an indexed directory was modified."""
+        if self.check_interval:
+            now = time.time()
+            if now < self._next_index_check:
+                return
+            self._next_index_check = now + self.check_interval
+        for directory, mtime in list(self._index_mtimes.items()):
+            try:
+                changed = os.stat(directory).st_mtime != mtime
+            except OSError:
+                changed = True
+            if changed:
+                with self._mutex:
+                    self.build_index()
+                return
+
+    def resolve(self, uri):
+        """Returns the file the template ``uri`` would be loaded from, or
+        `None` if it can't be found."""
+        key = _normalize_uri(uri)
+        if self.index is not None and key in self.index:
+            return self.index[key]
+        for directory in self.directories:
+            filename = posixpath.normpath(posixpath.join(directory, key))
+            if os.path.isfile(filename):
+                return filename
+        return None
+
+    def adopt(self, template):
+        """Adds a template compiled by a lookup with the same options to this
+        one, without compiling it again."""
+        key = _normalize_uri(template.uri)
+        previous = template.lookup
+        if key in previous._unparsed:
+            self._unparsed[key] = previous._unparsed[key]
+        elif key in previous._dependencies:
+            self._dependencies.add(key,
+                                   previous._dependencies.dependencies(key))
+        template = copy.copy(template)
+        template.lookup = self
+        # the cache is bound to the previous template object
+        template.__dict__.pop('cache', None)
+        self._collection[template.uri] = template
+        return template
+
+    def invalidate(self, uri=None):
+        """Drops the compiled template ``uri`` and the templates depending on
+        it according to the :attr:`dependency_graph`, or all of them, so
+        that they are loaded again on their next use. Returns the set of the
+        uris of the dropped templates, or `None` when all were."""
+        if uri is None:
+            with self._mutex:
+                self._collection.clear()
+                self._uri_cache.clear()
+                self._next_checks.clear()
+                self._digests.clear()
+            if self.on_invalidate is not None:
+                self.on_invalidate(None)
+            return None
+        key = _normalize_uri(uri)
+        return self._invalidate(self.dependency_graph.dependents(key) |
+                                set([key]))
+
+    def _invalidate(self, keys, reloaded=()):
+        with self._mutex:
+            for uri in list(self._collection.keys()):
+                if _normalize_uri(uri) in keys:
+                    self._collection.pop(uri, None)
+                    self._next_checks.pop(uri, None)
+            for key in keys:
+                self._digests.pop(key, None)
+        keys = keys | set(reloaded)
+        if self.on_invalidate is not None:
+            self.on_invalidate(keys)
+        return keys
+
+    @property
+    def dependency_graph(self):
+        """The :class:`DependencyGraph` of the templates loaded by this
+        lookup. Templates loaded from ``module_directory`` without being
+        compiled are only parsed to find their dependencies when the graph
+        is first used afterwards."""
+        if self._unparsed:
+            with self._parse_lock:
+                with self._mutex:
+                    unparsed, self._unparsed = self._unparsed, {}
+                for uri, filename in unparsed.items():
+                    try:
+                        self.parse_dependencies(uri, filename)
+                    except (IOError, OSError, exceptions.MakoException):
+                        # removed, or broken since it was loaded
+                        pass
+        return self._dependencies
+
+    def parse_dependencies(self, uri, filename=None):
+        """Parses the template ``uri`` to record its dependencies in the
+        :attr:`dependency_graph`, without compiling it."""
+        if filename is None:
+            filename = self.resolve(uri)
+        lexer = Lexer(util.read_file(filename), filename,
+                      input_encoding=self.template_args['input_encoding'],
+                      preprocessor=self.template_args['preprocessor'])
+        self._add_dependencies(uri, _node_dependencies(lexer.parse()))
+
+    def _add_dependencies(self, uri, found):
+        key = _normalize_uri(uri)
+        self._unparsed.pop(key, None)
+        self._dependencies.add(key, [_normalize_uri(self.adjust_uri(name, uri))
+                                     for name in found])
+
+    def template_version(self, uri):
+        """Returns a digest of the source of the template ``uri`` and of the
+        templates it depends on, directly or not, according to the
+        :attr:`dependency_graph`. It only changes with the template files,
+        so it is the same in every process using the same files.
+
+        With filesystem checks enabled, only these files are checked for
+        changes, at most once per :attr:`check_interval`, otherwise their
+        digest is computed once, until :meth:`invalidate` is called.
+
+        """
+        digests = {}
+        pending = [_normalize_uri(uri)]
+        while pending:
+            key = pending.pop()
+            if key not in digests:
+                digests[key] = self._source_digest(key)
+                pending.extend(self._dependencies.dependencies(key))
+        return hashlib.sha1(
+            repr(sorted(digests.items())).encode('utf-8')).hexdigest()
+
+    def _source_digest(self, key):
+        filename = self.resolve(key)
+        if filename is None:
+            return None
+        now = time.time()
+        entry = self._digests.get(key)
+        if entry is not None and entry[0] == filename and (
+                not self.filesystem_checks or now < entry[3]):
+            return entry[2]
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        stamp = (stat.st_mtime, stat.st_size)
+        if entry is not None and entry[:2] == (filename, stamp):
+            digest = entry[2]
+        else:
+            digest = hashlib.sha1(util.read_file(filename)).hexdigest()
+            if entry is not None or key not in self._dependencies:
+                # the dependencies may have changed along with the source
+                try:
+                    self.parse_dependencies(key, filename)
+                except exceptions.MakoException:
+                    pass
+        self._digests[key] = (filename, stamp, digest,
+                              now + self.check_interval)
+        return digest
+
+    def get_template(self, uri):
+        if self.index is None or uri in self._collection:
+            return super(MakoTemplateLookup, self).get_template(uri)
+
+        key = _normalize_uri(uri)
+        if _is_hidden(key):
+            # not indexed
+            return super(MakoTemplateLookup, self).get_template(uri)
+        filename = self.index.get(key)
+        if not self.filesystem_checks:
+            if filename is None:
+                raise exceptions.TopLevelLookupException(
+                    "Can't locate template for uri {0!r}".format(uri))
+            return self._load(filename, uri)
+
+        if filename is None:
+            # the template may have been created since the index was built
+            self._refresh_index()
+            filename = self.index.get(key)
+            if filename is None:
+                raise exceptions.TopLevelLookupException(
+                    "Can't locate template for uri {0!r}".format(uri))
+        else:
+            # a template created since in a folder searched first shadows
+            # the indexed one
+            position = self._index_positions.get(key, 0)
+            for directory in self.directories[:position]:
+                candidate = posixpath.normpath(posixpath.join(directory,
+                                                              key))
+                if os.path.isfile(candidate):
+                    filename = candidate
+                    break
+        if os.path.isfile(filename):
+            return self._load(filename, uri)
+        return super(MakoTemplateLookup, self).get_template(uri)
+
+    def _check(self, uri, template):
+        if self.check_interval:
+            now = time.time()
+            if now < self._next_checks.get(uri, 0):
+                return template
+            self._next_checks[uri] = now + self.check_interval
+        try:
+            checked = super(MakoTemplateLookup, self)._check(uri, template)
+        except exceptions.TemplateLookupException:
+            # the file was removed
+            self.invalidate(uri)
+            raise
+        if checked is not template:
+            # the file changed, so did the output of its dependents
+            key = _normalize_uri(uri)
+            self._invalidate(self.dependency_graph.dependents(key), [key])
+        return checked
+
+    def check_for_changes(self, uri):
+        """With filesystem checks enabled, checks the files of the compiled
+        template ``uri`` and of the compiled templates it depends on, like
+        :meth:`get_template` does, so that those which changed are dropped
+        along with their dependents and their cached fragments."""
+        if not self.filesystem_checks:
+            return
+        checked = set()
+        pending = [_normalize_uri(uri)]
+        while pending:
+            key = pending.pop()
+            if key in checked:
+                continue
+            checked.add(key)
+            # templates may have been loaded with or without a leading slash
+            for name in (key, '/' + key):
+                try:
+                    template = self._collection[name]
+                except KeyError:
+                    continue
+                try:
+                    self._check(name, template)
+                except exceptions.TemplateLookupException:
+                    pass
+            filename = self._unparsed.get(key)
+            if filename is not None:
+                try:
+                    self.parse_dependencies(key, filename)
+                except (IOError, OSError, exceptions.MakoException):
+                    pass
+            pending.extend(self._dependencies.dependencies(key))
+
+    def resident_templates(self):
+        """Returns ``(uri, size)`` tuples for the compiled templates, ``size``
+        being their estimated footprint in bytes as computed by
+        :func:`template_footprint`."""
+        collection = self._collection
+        if isinstance(collection, SizedTemplateCollection):
+            return collection.sizes()
+        resident = []
+        for uri in list(collection.keys()):
+            try:
+                template = collection[uri]
+            except KeyError:
+                continue
+            resident.append((uri, template_footprint(template)))
+        return resident
+
+    def compile_info(self):
+        """Returns a :data:`CompileInfo` ``(compiled, duplicates_avoided)``
+        named tuple: the number of templates compiled, and the number of
+        times a thread waited for another one compiling the same template
+        and used its result.
+
+        Mako's own lookup never compiles a template twice either, as it
+        compiles under a lookup-wide lock; compiling under a lock per
+        template instead lets different templates compile in parallel.
+        """
+        return CompileInfo(self.compiled, self.duplicates_avoided)
+
+    def _load(self, filename, uri):
+        # Mako compiles under the lookup-wide mutex; a lock per uri still
+        # makes the threads loading the same template wait for the one
+        # compiling it, while different templates compile in parallel
+        with self._mutex:
+            lock = self._compile_locks.get(uri)
+            if lock is None:
+                lock = self._compile_locks[uri] = threading.Lock()
+        with lock:
+            try:
+                template = self._collection[uri]
+            except KeyError:
+                pass
+            else:
+                with self._mutex:
+                    self.duplicates_avoided += 1
+                return template
+            start = time.time()
+            try:
+                template = self._create_template(filename, uri)
+            except:
+                self._collection.pop(uri, None)
+                raise
+            else:
+                self._collection[uri] = template
+            finally:
+                with self._mutex:
+                    if self._compile_locks.get(uri) is lock:
+                        del self._compile_locks[uri]
+        with self._mutex:
+            self.compiled += 1
+        if self.stats is not None:
+            self.stats.record_compile(uri, time.time() - start)
+        if self.check_interval:
+            self._next_checks[uri] = start + self.check_interval
+        return template
+
+    def _create_template(self, filename, uri):
+        if self.modulename_callable is not None:
+            module_filename = self.modulename_callable(filename, uri)
+        else:
+            module_filename = None
+        template_args = self.template_args
+        if template_args['lexer_cls'] is None:
+            template_args = dict(template_args, lexer_cls=_RecordingLexer)
+        # the cache has to be set before __init__, which compiles the code
+        template = _BytecodeTemplate.__new__(_BytecodeTemplate)
+        template.bytecode_cache = self.bytecode_cache
+        _lexed.dependencies = None
+        try:
+            template.__init__(uri=uri, filename=posixpath.normpath(filename),
+                              lookup=self, module_filename=module_filename,
+                              **template_args)
+            found = _lexed.dependencies
+        finally:
+            _lexed.dependencies = None
+        if found is None:
+            # the module was loaded without being compiled: the template is
+            # only parsed once the dependency graph is needed
+            with self._mutex:
+                self._unparsed[_normalize_uri(uri)] = template.filename
+        else:
+            self._add_dependencies(uri, found)
+        return template
+
+
+class _CompactModuleInfo(ModuleInfo):
+    """Module information keeping the template and generated module sources
+    compressed, only decompressing them to translate errors."""
+
+    def __init__(self, template, info):
+        ModuleInfo.__init__(self, template.module, None, template,
+                            info.template_filename, None, None,
+                            info.template_uri)
+        self.compressed = zlib.compress(
+            marshal.dumps((info.module_source, info.template_source)))
+
+    @property
+    def code(self):
+        return marshal.loads(zlib.decompress(self.compressed))[0]
+
+    @property
+    def source(self):
+        source = marshal.loads(zlib.decompress(self.compressed))[1]
+        if isinstance(source, bytes) and self.module._source_encoding:
+            return source.decode(self.module._source_encoding)
+        return source
+
+
+def _compact(template):
+    """Drops the sources a compiled template keeps in memory, keeping only
+    a compressed copy for error translation."""
+    info = template._mmarker
+    if not isinstance(info, _CompactModuleInfo):
+        _CompactModuleInfo(template, info)
+    template._code = template._source = None
+    return template
+
+
+class TemplateCache(object):
+    """
+    A thread-safe LRU mapping of compiled :class:`~mako.template.Template`
+    objects, keyed on a hash of their source. Used by
+    :func:`render_template_string` so that rendering the same source twice
+    doesn't lex, parse and compile it twice.
+
+    A ``maxsize`` of -1 means the cache is unbounded, and 0 disables it.
+    When ``compact`` is true, the cached templates only keep a compressed
+    copy of their template and generated sources, which are only needed to
+    translate errors.
+
+    """
+
+    def __init__(self, maxsize=-1, compact=False):
+        self.maxsize = maxsize
+        self.compact = compact
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(source):
+        """Returns the cache key for the given template source."""
+        if not isinstance(source, bytes):
+            source = source.encode('utf-8')
+        return hashlib.sha1(source).hexdigest()
+
+    def get(self, key):
+        """Returns the template cached under ``key`` or `None`."""
+        with self._lock:
+            try:
+                template = self._templates.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._templates[key] = template
+            self.hits += 1
+            return template
+
+    def set(self, key, template):
+        """Caches ``template`` under ``key``, evicting the least recently
+        used templates if the cache is full."""
+        if self.maxsize == 0:
+            return
+        if self.compact:
+            _compact(template)
+        with self._lock:
+            self._templates.pop(key, None)
+            self._templates[key] = template
+            while 0 < self.maxsize < len(self._templates):
+                self._templates.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def cache_info(self):
+        """Returns a :data:`CacheInfo` ``(hits, misses, maxsize, currsize)``
+        named tuple."""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+    def footprints(self):
+        """Returns ``(key, size)`` tuples for the cached templates, from the
+        most to the least recently used, ``size`` being their estimated
+        footprint in bytes as computed by :func:`template_footprint`."""
+        with self._lock:
+            templates = list(self._templates.items())
+        return [(key, template_footprint(template))
+                for key, template in reversed(templates)]
+
+
+class PrecompileSummary(object):
+    """
+    The outcome of :meth:`MakoTemplates.precompile`. Iterating over it yields
+    the names of the successfully compiled templates.
+
+    .. attribute:: timings
+
+        An ordered mapping of compiled template names to their compile time,
+        in seconds.
+
+    .. attribute:: failures
+
+        An ordered mapping of the names of the templates that failed to
+        compile to the error message.
+
+    .. attribute:: duration
+
+        The total wall clock time of the precompilation, in seconds.
+
+    """
+
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.failures = OrderedDict()
+        self.duration = 0
+
+    def __iter__(self):
+        return iter(self.timings)
+
+    def __len__(self):
+        return len(self.timings)
+
+    def add(self, uri, elapsed, error=None):
+        if error is None:
+            self.timings[uri] = elapsed
+        else:
+            self.failures[uri] = error
+
+    def report(self, verbose=False):
+        """Returns a human readable summary of the precompilation. If
+        ``verbose`` is `True`, the compile time of each template is listed."""
+        lines = []
+        if verbose:
+            for uri, elapsed in self.timings.items():
+                lines.append("{0:8.3f}s  {1}".format(elapsed, uri))
+        for uri, error in self.failures.items():
+            lines.append("FAILED  {0}: {1}".format(uri, error))
+        lines.append("Compiled {0} templates in {1:.3f}s, {2} failed.".format(
+            len(self.timings), self.duration, len(self.failures)))
+        return "\n".join(lines)
+
+
+class FragmentCache(object):
+    """
+    Base class for the fragment cache backends used to cache the output of
+    defs rendered with :func:`render_template_def`. Entries are keyed on a
+    ``(template_name, def_name, key)`` tuple, where ``key`` is computed from
+    the render context by the function given to
+    :meth:`MakoTemplates.cache_fragment`.
+
+    Subclasses must implement :meth:`get`, :meth:`set` and :meth:`delete`.
+
+    """
+
+    def __init__(self, default_timeout=None):
+        self.default_timeout = default_timeout
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time.time() + timeout if timeout else None
+
+    def get(self, key):
+        """Returns the output cached under ``key``, or `None`."""
+        raise NotImplementedError()
+
+    def set(self, key, value, timeout=None):
+        """Caches ``value`` under ``key`` for ``timeout`` seconds, or
+        :attr:`default_timeout` seconds if it is `None`. A timeout of 0 or
+        `None` means the value never expires."""
+        raise NotImplementedError()
+
+    def delete(self, template_name=None, def_name=None, key=None):
+        """Removes the cached outputs of the given template, def and key.
+        Omitted arguments match everything, so calling it without arguments
+        clears the cache."""
+        raise NotImplementedError()
+
+
+class MemoryFragmentCache(FragmentCache):
+    """
+    Keeps up to ``maxsize`` fragments in memory, evicting the least recently
+    used ones first. A ``maxsize`` of -1 means there is no limit.
+
+    """
+
+    def __init__(self, maxsize=1000, default_timeout=None):
+        super(MemoryFragmentCache, self).__init__(default_timeout)
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires <= time.time():
+                return None
+            self._entries[key] = expires, value
+            return value
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = self._expires(timeout), value
+            while 0 < self.maxsize < len(self._entries):
+                self._entries.popitem(last=False)
+
+    def delete(self, template_name=None, def_name=None, key=None):
+        pattern = (template_name, def_name, key)
+        with self._lock:
+            for entry_key in list(self._entries):
+                if all(p is None or p == k
+                       for p, k in zip(pattern, entry_key)):
+                    del self._entries[entry_key]
+
+
+class FileSystemFragmentCache(FragmentCache):
+    """
+    Stores fragments as pickled files in ``directory``, which can be shared
+    by several processes. Files are laid out by template, then def, so that
+    invalidating a template or a def removes a single directory.
+
+    """
+
+    def __init__(self, directory, default_timeout=None):
+        super(FileSystemFragmentCache, self).__init__(default_timeout)
+        self.directory = directory
+
+    def _path(self, *parts):
+        names = [hashlib.sha1(repr(part).encode('utf-8')).hexdigest()
+                 for part in parts]
+        return os.path.join(self.directory, *names)
+
+    def get(self, key):
+        try:
+            with open(self._path(*key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires <= time.time():
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        path = self._path(*key)
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((self._expires(timeout), value), f,
+                        pickle.HIGHEST_PROTOCOL)
+        _replace_file(tmp, path)
+
+    def delete(self, template_name=None, def_name=None, key=None):
+        if template_name is None:
+            path = self.directory
+        elif def_name is None:
+            path = self._path(template_name)
+        elif key is None:
+            path = self._path(template_name, def_name)
+        else:
+            try:
+                os.remove(self._path(template_name, def_name, key))
+            except OSError:
+                pass
+            return
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class TemplateStats(object):
+    """
+    Statistics of a template, or of one of its defs, collected when
+    ``MAKO_COLLECT_STATS`` is enabled. Render durations are in seconds, and
+    output sizes are in characters, or bytes if the output is encoded.
+
+    """
+
+    def __init__(self, uri, def_name=None):
+        self.uri = uri
+        self.def_name = def_name
+        self.renders = 0
+        self.render_time = 0.0
+        self.max_render_time = 0.0
+        self.output_size = 0
+        self.compiles = 0
+        self.compile_time = 0.0
+        self.cache_hits = 0
+        self._samples = deque(maxlen=_STATS_SAMPLES)
+
+    @property
+    def mean_render_time(self):
+        return self.render_time / self.renders if self.renders else 0.0
+
+    def percentile(self, percent):
+        """Returns the given percentile of the latest render durations."""
+        samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+    def as_dict(self):
+        return {
+            'uri': self.uri,
+            'def_name': self.def_name,
+            'renders': self.renders,
+            'render_time': self.render_time,
+            'mean_render_time': self.mean_render_time,
+            'max_render_time': self.max_render_time,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'output_size': self.output_size,
+            'compiles': self.compiles,
+            'compile_time': self.compile_time,
+            'cache_hits': self.cache_hits,
+        }
+
+
+class RenderStats(object):
+    """
+    The :class:`TemplateStats` of all the templates and defs of an
+    application, as returned by :meth:`MakoTemplates.stats`. Templates
+    rendered from a string are recorded under ``'string:'`` followed by the
+    hash of their source.
+
+    At most ``max_entries`` templates and defs are tracked, the least
+    recently used ones being dropped first; -1 means no limit.
+
+    """
+
+    def __init__(self, max_entries=-1):
+        self.max_entries = max_entries
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, uri, def_name):
+        # must be called with the lock held
+        key = (uri, def_name)
+        stats = self._stats.pop(key, None)
+        if stats is None:
+            stats = TemplateStats(uri, def_name)
+        self._stats[key] = stats
+        while 0 < self.max_entries < len(self._stats):
+            self._stats.popitem(last=False)
+        return stats
+
+    def record_render(self, template, duration, output_size):
+        uri, def_name = _template_key(template)
+        with self._lock:
+            stats = self._get_or_create(uri, def_name)
+            stats.renders += 1
+            stats.render_time += duration
+            stats.max_render_time = max(stats.max_render_time, duration)
+            stats.output_size += output_size
+            stats._samples.append(duration)
+
+    def record_compile(self, uri, duration):
+        with self._lock:
+            stats = self._get_or_create(uri, None)
+            stats.compiles += 1
+            stats.compile_time += duration
+
+    def record_cache_hit(self, uri, def_name=None):
+        with self._lock:
+            stats = self._get_or_create(uri, def_name)
+            stats.cache_hits += 1
+
+    def get(self, uri, def_name=None):
+        """Returns the :class:`TemplateStats` of a template or def, or `None`
+        if it wasn't used yet."""
+        with self._lock:
+            return self._stats.get((uri, def_name))
+
+    def __len__(self):
+        return len(self._stats)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._stats.values()))
+
+    def snapshot(self):
+        """Returns the statistics of all templates and defs as a list of
+        dictionaries, slowest templates first."""
+        return sorted((stats.as_dict() for stats in self),
+                      key=lambda d: d['render_time'], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# whether the current thread is being profiled
+_profiling = threading.local()
+
+
+class _ProfiledThread(object):
+    """Traces the template frames executed by a thread, charging the time
+    elapsed between two trace events to the template stack of the first."""
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.times = {}
+        self.stack = None
+        self.last = _clock()
+
+    def charge(self):
+        now = _clock()
+        if self.stack is not None:
+            self.times[self.stack] = (self.times.get(self.stack, 0) +
+                                      now - self.last)
+        self.last = now
+
+    def template_stack(self, frame):
+        stack = []
+        while frame is not None:
+            location = self.profiler._locate(frame)
+            if location is not None:
+                stack.append(location)
+            frame = frame.f_back
+        return tuple(reversed(stack)) or None
+
+    def trace(self, frame, event, arg):
+        if self.profiler._module(frame.f_code.co_filename) is None:
+            return None
+        self.charge()
+        self.stack = self.template_stack(frame)
+        return self.trace_lines
+
+    def trace_lines(self, frame, event, arg):
+        self.charge()
+        if event == 'return':
+            self.stack = self.template_stack(frame.f_back)
+        else:
+            self.stack = self.template_stack(frame)
+        return self.trace_lines
+
+
+class TemplateProfiler(object):
+    """
+    Attributes render time to template uris, defs and template source lines.
+    The compiled template modules are traced while profiling, and their
+    lines mapped back to the template source as in tracebacks. Time spent in
+    Python code called from a template line is attributed to that line, and
+    time spent in a def called from a template line to the def.
+
+    To profile a single request or block of code::
+
+        profiler = TemplateProfiler()
+        with profiler.profile():
+            html = render_template('page.html', **context)
+        print(profiler.report())
+
+    Tracing slows rendering down several times, so with ``sample_rate``,
+    :meth:`sample` only selects one render in that many.
+
+    """
+
+    def __init__(self, sample_rate=1):
+        self.sample_rate = sample_rate
+        self.renders = 0
+        self._count = itertools.count()
+        self._times = {}
+        self._modules = {}
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """Returns whether the current render should be profiled."""
+        return (self.sample_rate <= 1 or
+                not next(self._count) % self.sample_rate)
+
+    @contextmanager
+    def profile(self):
+        """Profiles the templates rendered by the current thread within the
+        ``with`` block. Nested blocks are profiled by the outermost one."""
+        if getattr(_profiling, 'active', False):
+            yield self
+            return
+        thread = _ProfiledThread(self)
+        previous = sys.gettrace()
+        _profiling.active = True
+        sys.settrace(thread.trace)
+        try:
+            yield self
+        finally:
+            sys.settrace(previous)
+            _profiling.active = False
+            thread.charge()
+            with self._lock:
+                self.renders += 1
+                for stack, duration in thread.times.items():
+                    self._times[stack] = self._times.get(stack, 0) + duration
+
+    def _module(self, filename):
+        """Returns the ``(uri, line_map, module_info)`` of the template module
+        compiled from ``filename``, or `None` if it isn't a template."""
+        try:
+            return self._modules[filename]
+        except KeyError:
+            pass
+        try:
+            info = _get_module_info(filename)
+        except KeyError:
+            module = None
+        else:
+            metadata = ModuleInfo.get_module_source_metadata(
+                info.code, full_line_map=True)
+            module = (metadata['uri'], metadata['full_line_map'], info)
+        self._modules[filename] = module
+        return module
+
+    def _locate(self, frame):
+        """Returns the ``(uri, def_name, line)`` a frame is executing."""
+        module = self._module(frame.f_code.co_filename)
+        if module is None:
+            return None
+        uri, line_map, _ = module
+        name = frame.f_code.co_name
+        if not name.startswith('render_'):
+            # the closures wrapping defs, whose time goes to their caller
+            return None
+        name = name[len('render_'):]
+        lineno = frame.f_lineno
+        line = line_map[lineno - 1] if lineno <= len(line_map) else None
+        return uri, name, line
+
+    def _source_line(self, uri, line):
+        for module in list(self._modules.values()):
+            if module is not None and module[0] == uri:
+                lines = module[2].source.splitlines()
+                if line and line <= len(lines):
+                    return lines[line - 1].strip()
+        return ''
+
+    def stacks(self):
+        """Returns a dictionary mapping template stacks, tuples of ``(uri,
+        def_name, line)`` from the outermost template frame, to the seconds
+        spent in their innermost frame."""
+        with self._lock:
+            return dict(self._times)
+
+    def lines(self):
+        """Returns ``((uri, def_name, line), seconds)`` tuples, the slowest
+        lines first."""
+        totals = {}
+        for stack, duration in self.stacks().items():
+            totals[stack[-1]] = totals.get(stack[-1], 0) + duration
+        return sorted(totals.items(), key=lambda item: -item[1])
+
+    def defs(self):
+        """Returns ``((uri, def_name), seconds)`` tuples, the slowest defs
+        first. The time of a def excludes the defs it calls."""
+        totals = {}
+        for (uri, name, _), duration in self.lines():
+            totals[uri, name] = totals.get((uri, name), 0) + duration
+        return sorted(totals.items(), key=lambda item: -item[1])
+
+    def folded(self):
+        """Returns the profile in the folded stacks format read by
+        FlameGraph and speedscope, one ``frame;frame;frame microseconds``
+        line per stack."""
+        lines = []
+        for stack, duration in sorted(self.stacks().items()):
+            frames = ';'.join('{0}:{1}:{2}'.format(*frame) for frame in stack)
+            lines.append('{0} {1}'.format(frames, int(duration * 1e6)))
+        return '\n'.join(lines)
+
+    def report(self, limit=20):
+        """Returns a text report of the ``limit`` slowest defs and lines."""
+        lines = self.lines()
+        total = sum(duration for _, duration in lines) or 1.0
+        out = ['Template profile of {0} renders, {1:.2f}ms'.format(
+            self.renders, total * 1e3), '', 'Slowest defs:']
+        for (uri, name), duration in self.defs()[:limit]:
+            out.append('{0:10.2f}ms {1:5.1f}%  {2}:{3}'.format(
+                duration * 1e3, duration / total * 100, uri, name))
+        out.extend(['', 'Slowest lines:'])
+        for (uri, name, line), duration in lines[:limit]:
+            out.append('{0:10.2f}ms {1:5.1f}%  {2}:{3} ({4})  {5}'.format(
+                duration * 1e3, duration / total * 100, uri, line, name,
+                self._source_line(uri, line)))
+        return '\n'.join(out)
+
+    def reset(self):
+        with self._lock:
+            self._times.clear()
+            self.renders = 0
+
+
+class MakoTemplates(object):
+    """
+    Main class for bridging mako and flask. We try to stay as close as possible
+    to how Jinja2 is used in Flask, while at the same time surfacing the useful
+    stuff from Mako.
+
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._fragment_policies = {}
+        if app is not None:
+            self.init_app(app)
+        self.app = app
+
+
+    def init_app(self, app):
+        """
+        Initialize a :class:`~flask.Flask` application
+        for use with this extension. This method is useful for the factory
+        pattern of extension initialization. Example::
+
+            mako = MakoTemplates()
+
+            app = Flask(__name__)
+            mako.init_app(app)
+
+        .. note::
+            This call will fail if you called the :class:`MakoTemplates`
+            constructor with an ``app`` argument.
+
+        """
+        if self.app:
+            raise RuntimeError("Cannot call init_app when app argument was "
+                               "provided to MakoTemplates constructor.")
+
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+
+        app.extensions['mako'] = self
+        app._mako_lock = threading.RLock()
+        app._mako_lookup = None
+        app._mako_string_cache = None
+        app._mako_fragment_cache = None
+        app._mako_executor = None
+
+        app.config.setdefault('MAKO_INPUT_ENCODING', 'utf-8')
+        app.config.setdefault('MAKO_OUTPUT_ENCODING', 'utf-8')
+        app.config.setdefault('MAKO_MODULE_DIRECTORY', None)
+        app.config.setdefault('MAKO_COLLECTION_SIZE', -1)
+        app.config.setdefault('MAKO_COLLECTION_MAX_BYTES', None)
+        app.config.setdefault('MAKO_IMPORTS', None)
+        app.config.setdefault('MAKO_FILESYSTEM_CHECKS', True)
+        app.config.setdefault('MAKO_FILESYSTEM_CHECK_INTERVAL', 0)
+        app.config.setdefault('MAKO_TEMPLATE_INDEX', True)
+        app.config.setdefault('MAKO_BYTECODE_CACHE_DIR', None)
+        app.config.setdefault('MAKO_TRANSLATE_EXCEPTIONS', True)
+        app.config.setdefault('MAKO_ERROR_SUMMARY_INTERVAL', 0)
+        app.config.setdefault('MAKO_DEFAULT_FILTERS', None)
+        app.config.setdefault('MAKO_PREPROCESSOR', None)
+        app.config.setdefault('MAKO_STRICT_UNDEFINED', False)
+        app.config.setdefault('MAKO_STRING_CACHE_SIZE', 100)
+        app.config.setdefault('MAKO_STRING_CACHE_COMPACT', False)
+        app.config.setdefault('MAKO_PRECOMPILE', False)
+        app.config.setdefault('MAKO_TEMPLATE_EXTENSIONS', None)
+        app.config.setdefault('MAKO_PRELOAD', False)
+        app.config.setdefault('MAKO_STREAM_BUFFER_SIZE', 8192)
+        app.config.setdefault('MAKO_BUFFER_STRATEGY', 'list')
+        app.config.setdefault('MAKO_FRAGMENT_CACHE', 'memory')
+        app.config.setdefault('MAKO_FRAGMENT_CACHE_SIZE', 1000)
+        app.config.setdefault('MAKO_FRAGMENT_CACHE_DIR', None)
+        app.config.setdefault('MAKO_FRAGMENT_CACHE_TIMEOUT', None)
+        app.config.setdefault('MAKO_COLLECT_STATS', False)
+        app.config.setdefault('MAKO_STATS_MAX_ENTRIES', 1000)
+        app.config.setdefault('MAKO_CACHE_REQUEST_CONTEXT', False)
+        app.config.setdefault('MAKO_ASYNC_WORKERS', 4)
+        app.config.setdefault('MAKO_SIGNAL_SAMPLE_RATE', 1)
+        app.config.setdefault('MAKO_PROFILE', False)
+        app.config.setdefault('MAKO_PROFILE_SAMPLE_RATE', 1)
+
+        app._mako_render_count = itertools.count()
+        app._mako_stats = (
+            RenderStats(app.config['MAKO_STATS_MAX_ENTRIES'])
+            if app.config['MAKO_COLLECT_STATS'] else None)
+        app._mako_profiler = (
+            TemplateProfiler(app.config['MAKO_PROFILE_SAMPLE_RATE'])
+            if app.config['MAKO_PROFILE'] else None)
+        interval = app.config['MAKO_ERROR_SUMMARY_INTERVAL']
+        app._mako_error_summary = ErrorSummary(interval) if interval else None
+
+        if click is not None and hasattr(app, 'cli'):
+            app.cli.add_command(mako_cli)
+
+        if app.config['MAKO_PRELOAD']:
+            self.preload(app)
+        elif app.config['MAKO_PRECOMPILE']:
+            self.precompile(app)
+
+    def _get_app(self, app=None):
+        if app is not None:
+            return app
+        if self.app is not None:
+            return self.app
+        ctx = stack.top
+        if ctx is None:
+            raise RuntimeError("No application found. Either pass an app "
+                               "or work inside an application context.")
+        return ctx.app
+
+    def string_cache_info(self, app=None):
+        """
+        Returns the statistics of the compiled template cache used by
+        :func:`render_template_string`, as a :data:`CacheInfo`
+        ``(hits, misses, maxsize, currsize)`` named tuple.
+
+        """
+        app = self._get_app(app)
+        cache = app._mako_string_cache
+        if cache is None:
+            return CacheInfo(0, 0, app.config['MAKO_STRING_CACHE_SIZE'], 0)
+        return cache.cache_info()
+
+    def resident_templates(self, app=None):
+        """
+        Returns ``(uri, size)`` tuples for the templates currently compiled
+        and held in memory, ``size`` being their estimated footprint in
+        bytes. With ``MAKO_COLLECTION_MAX_BYTES``, they are ordered from the
+        most to the least recently used.
+
+        """
+        return _lookup(self._get_app(app)).resident_templates()
+
+    def compile_info(self, app=None):
+        """
+        Returns a :data:`CompileInfo` ``(compiled, duplicates_avoided)`` named
+        tuple for the current template lookup. Concurrent requests needing a
+        template which isn't compiled yet wait for a single thread to compile
+        it, and ``duplicates_avoided`` counts the requests which waited. Mako
+        already compiled each template only once, under a lookup-wide lock,
+        so this counts no saved compilations: what the lock per template
+        gains is that different templates compile in parallel.
+
+        """
+        return _lookup(self._get_app(app)).compile_info()
+
+    def string_cache_footprint(self, app=None):
+        """
+        Returns ``(key, size)`` tuples for the templates cached by
+        :func:`render_template_string`, from the most to the least recently
+        used, ``key`` being the hash of their source and ``size`` their
+        estimated footprint in bytes.
+
+        """
+        cache = self._get_app(app)._mako_string_cache
+        return cache.footprints() if cache is not None else []
+
+    def stats(self, app=None):
+        """
+        Returns the :class:`RenderStats` of the application, or `None` if
+        ``MAKO_COLLECT_STATS`` wasn't enabled when the extension was
+        initialized.
+
+        """
+        return self._get_app(app)._mako_stats
+
+    def error_summary(self, app=None):
+        """
+        Returns the :class:`ErrorSummary` counting the template errors of the
+        application, or `None` if ``MAKO_ERROR_SUMMARY_INTERVAL`` wasn't set
+        when the extension was initialized.
+
+        """
+        return self._get_app(app)._mako_error_summary
+
+    def profiler(self, app=None):
+        """
+        Returns the :class:`TemplateProfiler` the renders of the application
+        are profiled with, or `None` if ``MAKO_PROFILE`` wasn't enabled when
+        the extension was initialized.
+
+        """
+        return self._get_app(app)._mako_profiler
+
+    def shadowed_templates(self, app=None):
+        """
+        Returns a dictionary mapping the names of the templates found in
+        several template folders to the list of their files, in search
+        order. Only the first file of each list is ever rendered. Requires
+        ``MAKO_TEMPLATE_INDEX``.
+
+        """
+        lookup = _lookup(self._get_app(app))
+        if lookup.index is None:
+            raise RuntimeError("Shadowed templates are only known when "
+                               "MAKO_TEMPLATE_INDEX is enabled.")
+        return dict(lookup.shadowed)
+
+    def cache_fragment(self, template_name, def_name, key, timeout=None):
+        """
+        Caches the output of a def rendered with :func:`render_template_def`.
+        ``key`` is called with the context given to
+        :func:`render_template_def` and must return a hashable value
+        identifying the output, for instance::
+
+            mako.cache_fragment('rows.html', 'row',
+                                key=lambda context: context['item'].id)
+
+        The output is cached for ``timeout`` seconds, or
+        ``MAKO_FRAGMENT_CACHE_TIMEOUT`` if it is `None`, in the cache
+        backend selected by ``MAKO_FRAGMENT_CACHE``.
+
+        """
+        self._fragment_policies[template_name, def_name] = \
+            _FragmentPolicy(key, timeout)
+
+    def invalidate_fragment(self, template_name, def_name, app=None,
+                            **context):
+        """
+        Removes the cached output of a def for the given context, which must
+        be the same as the one given to :func:`render_template_def`.
+
+        """
+        policy = self._fragment_policies[template_name, def_name]
+        cache = _fragment_cache(self._get_app(app))
+        key = policy.key(context)
+        for as_text in (False, True):
+            cache.delete(template_name, def_name, _fragment_key(key, as_text))
+
+    def clear_fragments(self, template_name=None, def_name=None, app=None):
+        """
+        Removes the cached outputs of all the defs of ``template_name``, or
+        only of ``def_name`` if given. Without arguments, clears the whole
+        fragment cache.
+
+        """
+        _fragment_cache(self._get_app(app)).delete(template_name, def_name)
+
+    def reload(self, app=None):
+        """
+        Rebuilds the template lookup, for instance after registering
+        blueprints or changing the configuration. Compiled templates are
+        carried over to the new lookup when its options are unchanged and
+        they are still found in the same file; the fragments cached for the
+        other ones are dropped.
+
+        The new lookup replaces the previous one at once: requests being
+        rendered meanwhile finish with the previous lookup.
+
+        """
+        app = self._get_app(app)
+        with app._mako_lock:
+            previous = app._mako_lookup
+            lookup = _create_lookup(app)
+            if previous is not None:
+                same_options = previous.template_args == lookup.template_args
+                for uri in list(previous._collection.keys()):
+                    try:
+                        template = previous._collection[uri]
+                    except KeyError:
+                        continue
+                    if (same_options and template.filename and
+                            lookup.resolve(uri) == template.filename):
+                        lookup.adopt(template)
+                    elif app._mako_fragment_cache is not None:
+                        app._mako_fragment_cache.delete(uri)
+            app._mako_string_cache = _string_cache(app)
+            app._mako_lookup = lookup
+        return lookup
+
+    def invalidate(self, template=None, app=None):
+        """
+        Drops the compiled ``template`` and its cached fragments, so that it
+        is compiled again on its next use, along with the templates depending
+        on it according to :meth:`dependency_graph`, and returns the set of
+        their uris. Without arguments, drops all the compiled templates and
+        cached fragments, and indexes the template folders again.
+
+        """
+        app = self._get_app(app)
+        lookup = app._mako_lookup
+        if lookup is None:
+            return None
+        dropped = lookup.invalidate(template)
+        if template is None:
+            if lookup.index is not None:
+                lookup.build_index()
+            app._mako_string_cache.clear()
+        return dropped
+
+    def dependency_graph(self, app=None, full=False):
+        """
+        Returns the :class:`DependencyGraph` of the templates, recording
+        which ones inherit from, include or import the namespace of others.
+        It is filled as templates are compiled; with ``full``, the templates
+        which aren't compiled yet are parsed as well.
+
+        When a template file changes, the templates depending on it and
+        their cached fragments are dropped along with it.
+
+        """
+        app = self._get_app(app)
+        lookup = _lookup(app)
+        if full:
+            for uri, filename in _mako_templates(app, lookup):
+                if uri not in lookup.dependency_graph:
+                    lookup.parse_dependencies(uri, filename)
+        return lookup.dependency_graph
+
+    def precompile(self, app=None, processes=None):
+        """
+        Compiles every template found in the application's and its
+        blueprints' template folders, so that they don't have to be compiled
+        when first rendered. Only the files ending with one of the
+        ``MAKO_TEMPLATE_EXTENSIONS`` are compiled when it is set. The
+        compiled templates are loaded in the template lookup and, if
+        ``MAKO_MODULE_DIRECTORY`` is set, written there so that other
+        processes can load them as well. Returns a :class:`PrecompileSummary`.
+
+        If ``processes`` is given, templates are compiled in parallel by that
+        many worker processes, which requires ``MAKO_MODULE_DIRECTORY`` or
+        ``MAKO_BYTECODE_CACHE_DIR`` to be set, and the template options to
+        be picklable. Mako writes each module to a
+        temporary file which is then moved in place, so concurrent writers
+        never leave a partial module behind.
+
+        Setting ``MAKO_PRECOMPILE`` to `True` calls this method from
+        :meth:`init_app`, in which case blueprints must be registered before
+        the extension is initialized.
+
+        """
+        app = self._get_app(app)
+        lookup = _lookup(app)
+        templates = [uri for uri, _ in _mako_templates(app, lookup)]
+        summary = PrecompileSummary()
+        start = time.time()
+
+        if processes:
+            if ProcessPoolExecutor is None:
+                raise RuntimeError("Parallel precompilation requires the "
+                                   "concurrent.futures module.")
+            cache = lookup.bytecode_cache
+            if not lookup.module_directory and cache is None:
+                raise RuntimeError("Parallel precompilation requires "
+                                   "MAKO_MODULE_DIRECTORY or "
+                                   "MAKO_BYTECODE_CACHE_DIR to be set.")
+            options = dict(lookup.template_args,
+                           modulename_callable=lookup.modulename_callable)
+            try:
+                pickle.dumps(options, pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                raise RuntimeError("Parallel precompilation requires the "
+                                   "template options, such as "
+                                   "MAKO_PREPROCESSOR, to be picklable: "
+                                   "{0}: {1}".format(type(e).__name__, e))
+            cache_dir = cache.directory if cache is not None else None
+            executor = ProcessPoolExecutor(max_workers=processes)
+            try:
+                futures = [(uri, executor.submit(_compile_template, uri,
+                                                 lookup.directories, options,
+                                                 cache_dir))
+                           for uri in templates]
+                for uri, future in futures:
+                    try:
+                        summary.add(*future.result())
+                    except Exception as e:
+                        # the worker itself failed, or its result couldn't
+                        # be sent back
+                        summary.add(uri, 0, "{0}: {1}".format(
+                            type(e).__name__, e))
+            finally:
+                executor.shutdown()
+            # load the modules the workers wrote, which is a plain import
+            for uri in summary:
+                lookup.get_template(uri)
+        else:
+            for uri in templates:
+                summary.add(*_compile_template(uri, lookup=lookup))
+
+        summary.duration = time.time() - start
+        return summary
+
+    def preload(self, app=None, freeze=True):
+        """
+        Prepares the application to be forked into worker processes, as done
+        by ``gunicorn --preload`` or by uWSGI without ``lazy-apps``: the
+        template lookup is created and every template compiled in the current
+        process with :meth:`precompile`, so that the workers share them
+        copy-on-write instead of each compiling their own after the fork.
+        Returns the :class:`PrecompileSummary`.
+
+        With ``freeze``, all the objects allocated so far are then moved to
+        a permanent generation with :func:`gc.freeze` (Python 3.7 and later),
+        so that garbage collections in the workers don't write to, and so
+        copy, the memory pages they share.
+
+        Setting ``MAKO_PRELOAD`` to `True` calls this method from
+        :meth:`init_app`, in which case blueprints must be registered before
+        the extension is initialized.
+
+        """
+        app = self._get_app(app)
+        summary = self.precompile(app)
+        # the Jinja environment provides the template globals
+        app.jinja_env
+        _fragment_cache(app)
+        if freeze and hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+        return summary
+
+
+if click is not None:
+    mako_cli = AppGroup('mako', help="Commands for Mako templates.")
+
+    @mako_cli.command('compile')
+    @click.option('--processes', '-j', type=int, default=None,
+                  help="Compile templates in parallel with this many "
+                       "processes.")
+    @click.option('--verbose', '-v', is_flag=True,
+                  help="Show the compile time of every template.")
+    def compile_command(processes, verbose):
+        """Compile all templates of the application."""
+        app = current_app._get_current_object()
+        try:
+            summary = app.extensions['mako'].precompile(app,
+                                                        processes=processes)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo(summary.report(verbose=verbose))
+        if not (app.config['MAKO_MODULE_DIRECTORY'] or
+                app.config['MAKO_BYTECODE_CACHE_DIR']):
+            click.echo("Neither MAKO_MODULE_DIRECTORY nor "
+                       "MAKO_BYTECODE_CACHE_DIR is set, compiled templates "
+                       "were not saved.")
+        if summary.failures:
+            sys.exit(1)
+
+
+def _compile_template(uri, directories=None, options=None, cache_dir=None,
+                      lookup=None):
+    """Compiles a template with the given lookup, or with a lookup created
+    from ``directories``, ``options`` and ``cache_dir`` when run in a worker
+    process. Returns ``(uri, elapsed, error)``, where ``error`` is `None` on
+    success.
+    """
+    start = time.time()
+    try:
+        if lookup is None:
+            lookup = MakoTemplateLookup(directories=directories, **options)
+            if cache_dir is not None:
+                lookup.bytecode_cache = BytecodeCache(cache_dir)
+        lookup.get_template(uri)
+    except Exception as e:
+        return uri, time.time() - start, "{0}: {1}".format(
+            type(e).__name__, e)
+    return uri, time.time() - start, None
+
+
+def _template_directories(app):
+    """Returns the existing template folders of the application and its
+    blueprints, in the order they are searched for templates."""
+    if isinstance(app.template_folder, (list, tuple)):
+        paths = [os.path.join(app.root_path, tf) for tf in app.template_folder]
+    else:
+        paths = [os.path.join(app.root_path, app.template_folder)]
+    blueprints = getattr(app, 'blueprints', {})
+    for blueprint in itervalues(blueprints):
+        bp_tf = blueprint.template_folder
+        if bp_tf:
+            if isinstance(bp_tf, (list, tuple)):
+                paths.extend([os.path.join(blueprint.root_path, tf)
+                              for tf in bp_tf])
+            else:
+                paths.append(os.path.join(blueprint.root_path, bp_tf))
+    return [path for path in paths if os.path.isdir(path)]
+
+
+def _walk(directory):
+    """Like :func:`os.walk`, following symbolic links but not cycles of
+    them, skipping hidden directories and listing names in order."""
+    visited = set()
+    for root, dirs, files in os.walk(directory, followlinks=True):
+        real = os.path.realpath(root)
+        if real in visited:
+            dirs[:] = []
+            continue
+        visited.add(real)
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        yield root, dirs, sorted(files)
+
+
+def _is_hidden(uri):
+    """Returns whether ``uri`` is a name :func:`_iter_templates` skips."""
+    return any(part.startswith('.') for part in uri.split('/'))
+
+
+def _iter_templates(directories):
+    """Yields a ``(uri, filename)`` tuple for every file found in the given
+    template directories, skipping hidden files. Like with Mako lookups, the
+    first directory wins when a uri is found in several of them."""
+    seen = set()
+    for directory in directories:
+        for root, dirs, files in _walk(directory):
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                filename = os.path.join(root, name)
+                uri = os.path.relpath(filename, directory)
+                uri = uri.replace(os.path.sep, '/')
+                if uri not in seen:
+                    seen.add(uri)
+                    yield uri, filename
+
+
+def _directory_mtimes(directories):
+    """Returns a dictionary mapping the given directories and their
+    non-hidden subdirectories to their modification time."""
+    mtimes = {}
+    for directory in directories:
+        for root, dirs, files in _walk(directory):
+            try:
+                mtimes[root] = os.stat(root).st_mtime
+            except OSError:
+                pass
+    return mtimes
+
+
+def _mako_templates(app, lookup):
+    """Returns the sorted ``(uri, filename)`` tuples of the templates of the
+    lookup's directories whose name ends with one of the
+    ``MAKO_TEMPLATE_EXTENSIONS``, or of all of them if it isn't set."""
+    if lookup.index is not None:
+        templates = sorted(lookup.index.items())
+    else:
+        templates = list(_iter_templates(lookup.directories))
+    extensions = app.config['MAKO_TEMPLATE_EXTENSIONS']
+    if extensions:
+        if not isinstance(extensions, (list, tuple)):
+            extensions = [extensions]
+        extensions = tuple(extensions)
+        templates = [(uri, filename) for uri, filename in templates
+                     if uri.endswith(extensions)]
+    return templates
+
+
+def _create_lookup(app):
+    """Returns a :class:`TemplateLookup <mako.lookup.TemplateLookup>`
+    instance that looks for templates from the same places as Flask, ie.
+    subfolders named 'templates' in both the app folder and its blueprints'
+    folders.
+
+    If flask-babel is installed it will add support for it in the templates
+    by adding the appropriate imports clause.
+
+    """
+    # copied, so that the configuration is left untouched
+    imports = list(app.config['MAKO_IMPORTS'] or [])
+    imports.append(_FLASK_IMPORTS)
+
+    if 'babel' in app.extensions:
+        imports.append(_BABEL_IMPORTS)
+
+    # for beaker
+    cache_impl = app.config.get('MAKO_CACHE_IMPL')
+    cache_args = app.config.get('MAKO_CACHE_ARGS')
+
+    kw = {
+        'input_encoding': app.config['MAKO_INPUT_ENCODING'],
+        'output_encoding': app.config['MAKO_OUTPUT_ENCODING'],
+        'module_directory': app.config['MAKO_MODULE_DIRECTORY'],
+        'collection_size': app.config['MAKO_COLLECTION_SIZE'],
+        'imports': imports,
+        'filesystem_checks': app.config['MAKO_FILESYSTEM_CHECKS'],
+        'default_filters': app.config['MAKO_DEFAULT_FILTERS'],
+        'preprocessor': app.config['MAKO_PREPROCESSOR'],
+        'strict_undefined': app.config['MAKO_STRICT_UNDEFINED'],
+    }
+
+    if cache_impl:
+        kw['cache_impl'] = cache_impl
+
+    if cache_args:
+        kw['cache_args'] = cache_args
+
+    lookup = MakoTemplateLookup(
+        directories=_template_directories(app),
+        collection_max_bytes=app.config['MAKO_COLLECTION_MAX_BYTES'], **kw)
+    lookup.stats = app._mako_stats
+    lookup.check_interval = app.config['MAKO_FILESYSTEM_CHECK_INTERVAL']
+    if app.config['MAKO_BYTECODE_CACHE_DIR']:
+        lookup.bytecode_cache = BytecodeCache(
+            app.config['MAKO_BYTECODE_CACHE_DIR'])
+    lookup.on_invalidate = lambda uris: _drop_fragments(app, uris)
+    if app.config['MAKO_TEMPLATE_INDEX']:
+        lookup.build_index()
+    return lookup
+
+
+def _drop_fragments(app, uris):
+    """Drops the cached fragments of the given templates, or all of them if
+    ``uris`` is `None`."""
+    cache = app._mako_fragment_cache
+    if cache is None:
+        return
+    if uris is None:
+        cache.delete()
+        return
+    for uri in uris:
+        # templates may have been rendered with or without a leading slash
+        cache.delete(uri)
+        cache.delete('/' + uri)
+
+
+def _string_cache(app):
+    return TemplateCache(app.config['MAKO_STRING_CACHE_SIZE'],
+                         app.config['MAKO_STRING_CACHE_COMPACT'])
+
+
+def _lookup(app):
+    lookup = app._mako_lookup
+    if lookup is None:
+        # only one of the concurrent first requests creates the lookup
+        with app._mako_lock:
+            lookup = app._mako_lookup
+            if lookup is None:
+                lookup = _create_lookup(app)
+                # compiled string templates hold on to the lookup they were
+                # created with, so they can't outlive it
+                app._mako_string_cache = _string_cache(app)
+                app._mako_lookup = lookup
+    return lookup
+
+
+def _update_context(context, app):
+    """Adds the Jinja2 globals and the context processors' variables to the
+    given template context, and returns it.
+
+    Like with :meth:`~flask.Flask.update_template_context`, the globals win
+    over the given variables, which win over the context processors'. With
+    ``MAKO_CACHE_REQUEST_CONTEXT``, the context processors only run once per
+    application context, which usually means once per request.
+    """
+    globals = app.jinja_env.globals
+    ctx = stack.top
+    if not app.config['MAKO_CACHE_REQUEST_CONTEXT'] or ctx is None:
+        context.update(globals)
+        app.update_template_context(context)
+        return context
+
+    base = getattr(ctx, '_mako_context', None)
+    if base is None:
+        base = {}
+        app.update_template_context(base)
+        base.update(globals)
+        ctx._mako_context = base
+    return _layer_context(base, context, globals)
+
+
+def _layer_context(base, context, globals):
+    """Returns a copy of ``base``, an already updated template context, with
+    the given variables added, except for the ones shadowed by globals."""
+    rv = base.copy()
+    rv.update(context)
+    for key in context:
+        if key in globals:
+            rv[key] = globals[key]
+    return rv
+
+
+def _render_into(template, context, buf):
+    """Renders the template into the given buffer. This is what
+    :meth:`~mako.template.Template.render` does, except it lets us provide
+    the buffer."""
+    ctx = runtime.Context(buf, **context)
+    ctx._outputting_as_unicode = False
+    ctx._set_with_template(template)
+    kwargs = runtime._kwargs_for_callable(template.callable_, context)
+    runtime._render_context(template, template.callable_, ctx, **kwargs)
+
+
+#: The output buffer strategies, see :func:`buffer_strategy`.
+BUFFER_STRATEGIES = ('list', 'stringio', 'bytes')
+
+# the buffer strategy chosen with buffer_strategy() in the current thread
+_buffering = threading.local()
+
+
+@contextmanager
+def buffer_strategy(strategy):
+    """Selects the output buffer of the templates rendered by the current
+    thread within the ``with`` block, overriding ``MAKO_BUFFER_STRATEGY``::
+
+        with buffer_strategy('bytes'):
+            return render_template('export.html', rows=rows)
+
+    ``'list'`` is Mako's own buffer, joining the list of written strings
+    once rendered, then encoding the result. ``'stringio'`` writes into an
+    :class:`io.StringIO`. ``'bytes'`` encodes each string as it's written
+    into an :class:`io.BytesIO`, so that a large output never exists as a
+    whole in both its text and encoded forms, and requires an output
+    encoding.
+    """
+    if strategy not in BUFFER_STRATEGIES:
+        raise ValueError("Unknown buffer strategy {0!r}".format(strategy))
+    previous = getattr(_buffering, 'strategy', None)
+    _buffering.strategy = strategy
+    try:
+        yield
+    finally:
+        _buffering.strategy = previous
+
+
+class _BytesBuffer(object):
+    """A Mako output buffer encoding the text as it is written."""
+
+    def __init__(self, encoding, errors='strict'):
+        self.encoding = encoding
+        self.errors = errors
+        self._buf = io.BytesIO()
+
+    def write(self, text):
+        self._buf.write(text.encode(self.encoding, self.errors))
+
+    def getvalue(self):
+        return self._buf.getvalue()
+
+
+def _buffer_strategy(app, template, as_text=False):
+    """Returns the buffer strategy to render the template with."""
+    strategy = (getattr(_buffering, 'strategy', None) or
+                app.config['MAKO_BUFFER_STRATEGY'])
+    if strategy not in BUFFER_STRATEGIES:
+        raise ValueError("Unknown buffer strategy {0!r}".format(strategy))
+    if as_text and strategy == 'bytes':
+        # text is never encoded, so is best left to Mako's own buffer
+        return 'list'
+    if strategy == 'bytes' and not template.output_encoding:
+        raise ValueError("The bytes buffer strategy requires "
+                         "MAKO_OUTPUT_ENCODING to be set.")
+    return strategy
+
+
+def _render_buffered(template, context, strategy, as_text=False):
+    """Renders the template like :meth:`~mako.template.Template.render`, or
+    :meth:`~mako.template.Template.render_unicode` if ``as_text`` is true,
+    into a buffer of the given strategy."""
+    if strategy == 'list':
+        if as_text:
+            return template.render_unicode(**context)
+        return template.render(**context)
+    if strategy == 'bytes':
+        buf = _BytesBuffer(template.output_encoding, template.encoding_errors)
+        _render_into(template, context, buf)
+        return buf.getvalue()
+    buf = io.StringIO()
+    _render_into(template, context, buf)
+    rv = buf.getvalue()
+    if template.output_encoding and not as_text:
+        rv = rv.encode(template.output_encoding, template.encoding_errors)
+    return rv
+
+
+def _fragment_cache(app):
+    if app._mako_fragment_cache is None:
+        backend = app.config['MAKO_FRAGMENT_CACHE']
+        timeout = app.config['MAKO_FRAGMENT_CACHE_TIMEOUT']
+        if backend == 'memory':
+            backend = MemoryFragmentCache(
+                app.config['MAKO_FRAGMENT_CACHE_SIZE'], timeout)
+        elif backend == 'filesystem':
+            directory = app.config['MAKO_FRAGMENT_CACHE_DIR']
+            if not directory:
+                raise RuntimeError("The filesystem fragment cache requires "
+                                   "MAKO_FRAGMENT_CACHE_DIR to be set.")
+            backend = FileSystemFragmentCache(directory, timeout)
+        elif not isinstance(backend, FragmentCache):
+            raise ValueError("Unknown fragment cache {0!r}".format(backend))
+        app._mako_fragment_cache = backend
+    return app._mako_fragment_cache
+
+
+def _record_render(app, template, context, start, output_size, signal):
+    """Records the render duration of a template started at ``start`` in
+    the stats and sends the after_render signal if ``signal`` is true."""
+    duration = time.time() - start
+    if app._mako_stats is not None:
+        app._mako_stats.record_render(template, duration, output_size)
+    if signal:
+        after_render.send(app, template=template, context=context,
+                          duration=duration)
+
+
+def _render(template, context, app, as_text=False):
+    """Renders the template and fires the signal"""
+    return _render_updated(template, _update_context(context, app), app,
+                           as_text)
+
+
+def _render_updated(template, context, app, as_text=False):
+    """Renders the template with a context already updated by
+    :func:`_update_context`, and fires the signal. The output is text if
+    ``as_text`` is true, otherwise it is encoded with the template's output
+    encoding, if any."""
+    strategy = _buffer_strategy(app, template, as_text)
+    before, after, rendered = _signals_to_send(app)
+    timed = app._mako_stats is not None or after
+    if before:
+        before_render.send(app, template=template, context=context)
+    try:
+        if timed:
+            start = time.time()
+        profiler = app._mako_profiler
+        if profiler is not None and profiler.sample():
+            with profiler.profile():
+                rv = _render_buffered(template, context, strategy, as_text)
+        else:
+            rv = _render_buffered(template, context, strategy, as_text)
+        if timed:
+            _record_render(app, template, context, start, len(rv), after)
+        if rendered:
+            template_rendered.send(app, template=template, context=context)
+        return rv
+    except:
+        translate = app.config.get("MAKO_TRANSLATE_EXCEPTIONS")
+        if translate:
+            translated = TemplateError(template, app._mako_error_summary)
+            raise translated
+        else:
+            raise
+
+
+def _render_many(template, contexts, shared, app):
+    """Renders the template once for each of the given contexts, layered
+    over the ``shared`` context which is only updated once."""
+    base = _update_context(shared, app)
+    globals = app.jinja_env.globals
+    return [_render_updated(template, _layer_context(base, context, globals),
+                            app)
+            for context in contexts]
+
+
+class _StreamClosed(Exception):
+    """Raised in a streaming render thread when the stream was closed."""
+
+
+class _StreamBuffer(object):
+    """A Mako output buffer which hands its content over to another thread
+    through ``queue`` each time it reaches ``size`` characters or when
+    :meth:`flush` is called."""
+
+    def __init__(self, queue, closed, size, encoding=None, errors='strict'):
+        self.queue = queue
+        self.closed = closed
+        self.size = size
+        self.encoding = encoding
+        self.errors = errors
+        self._parts = []
+        self._length = 0
+
+    def write(self, text):
+        self._parts.append(text)
+        self._length += len(text)
+        if self._length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self._parts:
+            return
+        chunk = u''.join(self._parts)
+        self._parts = []
+        self._length = 0
+        if self.encoding:
+            chunk = chunk.encode(self.encoding, self.errors)
+        self.put(chunk)
+
+    def put(self, item):
+        while True:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Full:
+                if self.closed.is_set():
+                    raise _StreamClosed()
+
+
+if stack is _request_ctx_stack:
+    _context_stacks = (stack,)
+else:
+    _context_stacks = (stack, _request_ctx_stack)
+
+
+def _capture_contexts():
+    """Returns the active app and request contexts, so that another thread
+    can see them with :func:`_push_contexts`."""
+    return [(s, s.top) for s in _context_stacks if s.top is not None]
+
+
+def _push_contexts(contexts):
+    # The contexts are only made visible to the current thread, they still
+    # belong to the thread that pushed them, which is in charge of tearing
+    # them down.
+    for s, ctx in contexts:
+        s.push(ctx)
+
+
+def _pop_contexts(contexts):
+    for s, ctx in reversed(contexts):
+        s.pop()
+
+
+def _stream(template, context, app, keep_context=True):
+    """Renders the template in a separate thread and returns an iterator over
+    the rendered chunks, firing the signal once the template is fully
+    rendered."""
+    context = _update_context(context, app)
+    size = app.config['MAKO_STREAM_BUFFER_SIZE']
+    translate = app.config.get("MAKO_TRANSLATE_EXCEPTIONS")
+    before, after, rendered = _signals_to_send(app)
+    timed = app._mako_stats is not None or after
+
+    def generate():
+        if before:
+            before_render.send(app, template=template, context=context)
+        start = time.time()
+        output_size = 0
+        queue = Queue(_STREAM_QUEUE_SIZE)
+        closed = threading.Event()
+        buf = _StreamBuffer(queue, closed, size, template.output_encoding,
+                            template.encoding_errors)
+        context.setdefault('flush', buf.flush)
+        contexts = _capture_contexts()
+        done = object()
+
+        def run():
+            _push_contexts(contexts)
+            try:
+                try:
+                    _render_into(template, context, buf)
+                    buf.flush()
+                    result = done
+                except _StreamClosed:
+                    return
+                except:
+                    error = sys.exc_info()[1]
+                    result = (TemplateError(template, app._mako_error_summary)
+                              if translate else error)
+                    # errors are told apart from chunks by being a tuple
+                    result = (result,)
+                buf.put(result)
+            except _StreamClosed:
+                pass
+            finally:
+                _pop_contexts(contexts)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is done:
+                    break
+                if isinstance(item, tuple):
+                    raise item[0]
+                output_size += len(item)
+                yield item
+        finally:
+            closed.set()
+            thread.join()
+        if timed:
+            _record_render(app, template, context, start, output_size, after)
+        if rendered:
+            template_rendered.send(app, template=template, context=context)
+
+    if keep_context and _request_ctx_stack.top is not None:
+        return stream_with_context(generate())
+    return generate()
+
+
+_executor_lock = threading.Lock()
+
+
+def _executor(app):
+    if app._mako_executor is None:
+        with _executor_lock:
+            if app._mako_executor is None:
+                app._mako_executor = ThreadPoolExecutor(
+                    app.config['MAKO_ASYNC_WORKERS'])
+    return app._mako_executor
+
+
+def _run_async(function, *args, **kwargs):
+    """Calls the function in the thread pool of the current application,
+    with the current app and request contexts, and returns an awaitable
+    for its result."""
+    if asyncio is None or ThreadPoolExecutor is None:
+        raise RuntimeError("Async rendering requires asyncio.")
+    contexts = _capture_contexts()
+
+    def run():
+        _push_contexts(contexts)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _pop_contexts(contexts)
+
+    return asyncio.wrap_future(_executor(stack.top.app).submit(run))
+
+
+class _AsyncStream(object):
+    """An asynchronous iterator over a streamed template, whose chunks are
+    rendered in the thread pool of the application."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._iterator = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return _run_async(self._next)
+
+    def _next(self):
+        if self._iterator is None:
+            self._iterator = self._factory()
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration()
+
+
+def render_template(template_name, **context):
+    """Renders a template from the template folder with the given
+    context.
+
+    :param template_name: the name of the template to be rendered
+    :param context: the variables that should be available in the
+                    context of the template.
+    """
+    ctx = stack.top
+    return _render(_lookup(ctx.app).get_template(template_name),
+                   context, ctx.app)
+
+
+def render_template_text(template_name, **context):
+    """Renders a template like :func:`render_template`, but always returns
+    text, which is never encoded with ``MAKO_OUTPUT_ENCODING``: use it when
+    the output is composed into other strings rather than sent as a
+    response body, to avoid encoding then decoding it.
+
+    :param template_name: the name of the template to be rendered
+    :param context: the variables that should be available in the
+                    context of the template.
+    """
+    ctx = stack.top
+    return _render(_lookup(ctx.app).get_template(template_name),
+                   context, ctx.app, as_text=True)
+
+
+def render_template_string(source, **context):
+    """Renders a template from the given template source string
+    with the given context. Compiled templates are kept in a LRU cache keyed
+    on the source, whose size is set by ``MAKO_STRING_CACHE_SIZE``.
+
+    :param source: the sourcecode of the template to be
+                          rendered
+    :param context: the variables that should be available in the
+                    context of the template.
+    """
+    ctx = stack.top
+    lookup = _lookup(ctx.app)
+    cache = ctx.app._mako_string_cache
+    key = cache.key_for(source)
+    template = cache.get(key)
+    stats = ctx.app._mako_stats
+    if template is None:
+        start = time.time()
+        # named after the source rather than after the object id, so that
+        # statistics and errors of the same source are reported together
+        template = Template(source, lookup=lookup, uri='string:' + key)
+        cache.set(key, template)
+        if stats is not None:
+            stats.record_compile(template.uri, time.time() - start)
+    elif stats is not None:
+        stats.record_cache_hit(template.uri)
+    return _render(template, context, ctx.app)
+
+
+def render_template_def(template_name, def_name, **context):
+    """Renders a specific def from a given
+    template from the template folder with the given
+    context. Useful for implementing this AJAX pattern:
+
+    http://techspot.zzzeek.org/2008/09/01/ajax-the-mako-way
+
+    :param template_name: the name of the template file containing the def
+                    to be rendered
+    :param def_name: the name of the def to be rendered
+    :param context: the variables that should be available in the
+                    context of the template.
+
+    The output is cached if the def was registered with
+    :meth:`MakoTemplates.cache_fragment`.
+    """
+    return _render_def(stack.top.app, template_name, def_name, context)
+
+
+def render_template_def_text(template_name, def_name, **context):
+    """Renders a def like :func:`render_template_def`, but always returns
+    text. See :func:`render_template_text`.
+
+    :param template_name: the name of the template file containing the def
+                    to be rendered
+    :param def_name: the name of the def to be rendered
+    :param context: the variables that should be available in the
+                    context of the template.
+    """
+    return _render_def(stack.top.app, template_name, def_name, context,
+                       as_text=True)
+
+
+def _fragment_key(key, as_text):
+    # text and encoded outputs are cached separately
+    return (key, 'text') if as_text else key
+
+
+def _render_def(app, template_name, def_name, context, as_text=False):
+    """Renders a def, going through the fragment cache if the def was
+    registered with :meth:`MakoTemplates.cache_fragment`."""
+    policy = app.extensions['mako']._fragment_policies.get(
+        (template_name, def_name))
+    if policy is not None:
+        key = (template_name, def_name,
+               _fragment_key(policy.key(context), as_text))
+        cache = _fragment_cache(app)
+        # the template isn't looked up on a hit, yet a change of its file
+        # or of its dependencies' has to drop its fragments
+        _lookup(app).check_for_changes(template_name)
+        rv = cache.get(key)
+        if rv is not None:
+            if app._mako_stats is not None:
+                app._mako_stats.record_cache_hit(template_name, def_name)
+            return rv
+
+    template = _lookup(app).get_template(template_name)
+    rv = _render(template.get_def(def_name), context, app, as_text)
+    if policy is not None:
+        cache.set(key, rv, policy.timeout)
+    return rv
+
+
+def _template_etag(lookup, template_name, def_name, key):
+    """Returns a strong ETag identifying the output of the template or def
+    for the given context key. The template version is computed from the
+    sources of the template and of the templates it depends on, so that
+    every process gives the same ETag."""
+    identity = (_normalize_uri(template_name), def_name,
+                lookup.template_version(template_name), key)
+    return hashlib.sha1(repr(identity).encode('utf-8')).hexdigest()
+
+
+def render_template_response(template_name, key=None, def_name=None,
+                             max_age=0, **context):
+    """Renders a template, or one of its defs, into a response whose body is
+    the encoded output itself, and which supports conditional requests:
+    the response has a strong ETag, and requests whose ``If-None-Match``
+    header matches it are answered with an empty ``304 Not Modified``
+    response.
+
+    When the output only depends on the context through a known ``key``,
+    the ETag is computed from ``key`` and from the sources of the template
+    and of the templates it inherits from, includes or imports, and the
+    template isn't even rendered for a 304 response::
+
+        @app.route('/article/<int:id>')
+        def article(id):
+            article = Article.query.get_or_404(id)
+            return render_template_response(
+                'article.html', key=(id, article.updated_at), article=article)
+
+    ``key`` must have the same :func:`repr` for the same output, in every
+    process. Templates given by an expression, such as
+    ``<%include file="${name}"/>``, aren't part of the template version.
+    Without ``key``, the ETag is a hash of the rendered output.
+
+    :param template_name: the name of the template to be rendered
+    :param key: a value identifying the output for the given context.
+    :param def_name: the name of the def to be rendered, if any.
+    :param max_age: the number of seconds the response can be cached
+                    without being revalidated, sent in the
+                    ``Cache-Control`` header.
+    :param context: the variables that should be available in the
+                    context of the template.
+    """
+    ctx = stack.top
+    response_class = ctx.app.response_class
+    etag = None
+    if key is not None:
+        lookup = _lookup(ctx.app)
+        # raises if the template doesn't exist
+        lookup.get_template(template_name)
+        etag = _template_etag(lookup, template_name, def_name, key)
+        if (request.method in ('GET', 'HEAD') and
+                request.if_none_match.contains(etag)):
+            response = response_class(status=304)
+            response.set_etag(etag)
+            response.cache_control.max_age = max_age
+            return response
+
+    if def_name is None:
+        rv = render_template(template_name, **context)
+    else:
+        rv = render_template_def(template_name, def_name, **context)
+    encoding = _lookup(ctx.app).template_args['output_encoding']
+    if not isinstance(rv, bytes):
+        # encoded once here, rather than by the response
+        encoding = response_class.charset
+        rv = rv.encode(encoding)
+    # the body is used as is, its charset being the one it is encoded with
+    response = response_class(rv, content_type='{0}; charset={1}'.format(
+        response_class.default_mimetype, encoding))
+    if etag is None:
+        etag = hashlib.sha1(rv).hexdigest()
+    response.set_etag(etag)
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+def render_template_many(template_name, contexts, **context):
+    """Renders a template from the template folder once for each of the
+    given contexts, and returns the list of outputs. This is faster than
+    calling :func:`render_template` in a loop, as the template is looked up
+    and the shared context updated only once.
+
+    :param template_name: the name of the template to be rendered
+    :param contexts: an iterable of dictionaries of variables specific to
+                     each render.
+    :param context: the variables that should be available in the
+                    context of every render.
+    """
+    ctx = stack.top
+    template = _lookup(ctx.app).get_template(template_name)
+    return _render_many(template, contexts, context, ctx.app)
+
+
+def render_template_def_many(template_name, def_name, contexts, **context):
+    """Renders a specific def from a given template from the template folder
+    once for each of the given contexts, and returns the list of outputs.
+    Useful to render the rows of a table::
+
+        rows = render_template_def_many('rows.html', 'row',
+                                        [{'item': item} for item in items])
+
+    The outputs are not cached, even if the def was registered with
+    :meth:`MakoTemplates.cache_fragment`.
+
+    :param template_name: the name of the template file containing the def
+                    to be rendered
+    :param def_name: the name of the def to be rendered
+    :param contexts: an iterable of dictionaries of variables specific to
+                     each render.
+    :param context: the variables that should be available in the
+                    context of every render.
+    """
+    ctx = stack.top
+    template = _lookup(ctx.app).get_template(template_name)
+    return _render_many(template.get_def(def_name), contexts, context,
+                        ctx.app)
+
+
+def stream_template(template_name, **context):
+    """Renders a template from the template folder with the given context,
+    as an iterator over chunks of the output, which can be used as the body
+    of a :class:`~flask.Response`. This avoids keeping large pages in
+    memory, and the first chunks can be sent while the rest of the page is
+    rendered.
+
+    The template is rendered in a separate thread, a chunk being produced
+    every ``MAKO_STREAM_BUFFER_SIZE`` characters. Templates can also produce
+    a chunk at any point by calling ``flush()``, which is only available to
+    streamed templates.
+
+    :param template_name: the name of the template to be rendered
+    :param context: the variables that should be available in the
+                    context of the template.
+    """
+    ctx = stack.top
+    return _stream(_lookup(ctx.app).get_template(template_name),
+                   context, ctx.app)
+
+
+def stream_template_def(template_name, def_name, **context):
+    """Renders a specific def from a given template from the template folder
+    with the given context, as an iterator over chunks of the output. See
+    :func:`stream_template`.
+
+    :param template_name: the name of the template file containing the def
+                    to be rendered
+    :param def_name: the name of the def to be rendered
+    :param context: the variables that should be available in the
+                    context of the template.
+    """
+    ctx = stack.top
+    template = _lookup(ctx.app).get_template(template_name)
+    return _stream(template.get_def(def_name), context, ctx.app)
+
+
+def render_template_async(template_name, **context):
+    """Awaitable version of :func:`render_template`, for use in ``async``
+    views. The template is compiled and rendered in a thread pool of
+    ``MAKO_ASYNC_WORKERS`` threads, so that the event loop isn't blocked::
+
+        async def page():
+            return await render_template_async('page.html', name='mako')
+
+    """
+    return _run_async(render_template, template_name, **context)
+
+
+def render_template_string_async(source, **context):
+    """Awaitable version of :func:`render_template_string`. See
+    :func:`render_template_async`."""
+    return _run_async(render_template_string, source, **context)
+
+
+def render_template_def_async(template_name, def_name, **context):
+    """Awaitable version of :func:`render_template_def`. See
+    :func:`render_template_async`."""
+    return _run_async(render_template_def, template_name, def_name,
+                      **context)
+
+
+def stream_template_async(template_name, **context):
+    """Asynchronous version of :func:`stream_template`, returning an
+    asynchronous iterator over chunks of the output::
+
+        async for chunk in stream_template_async('report.html', rows=rows):
+            ...
+
+    """
+    def factory():
+        ctx = stack.top
+        template = _lookup(ctx.app).get_template(template_name)
+        return _stream(template, context, ctx.app, keep_context=False)
+    return _AsyncStream(factory)
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-import os, sys, tempfile
+import os, sys, tempfile, time
 
 if sys.version_info < (2, 7):
     import unittest2 as unittest
@@ -11,9 +11,13 @@ from contextlib import contextmanager
 import flask
 from flask import Flask, Blueprint, g
 from flask.ext.mako import (MakoTemplates, TemplateError, render_template,
-                            render_template_string, render_template_def)
+                            render_template_string, render_template_def,
+                            stream_template, stream_template_def,
+                            render_template_many, render_template_def_many,
+                            render_template_response, buffer_strategy,
+                            render_template_text, render_template_def_text)
 
-from mako.exceptions import CompileException
+from mako.exceptions import CompileException, TopLevelLookupException
 
 class MakoTestCase(unittest.TestCase):
 
@@ -195,6 +199,631 @@ class MakoDetailedTestCase(unittest.TestCase):
 
             result = render_template("vars")
 
+    def test_cache_request_context(self):
+        """ Tests that context processors can run once per request. """
+        self._add_template("processed",
+                           "${injected} ${value} ${config is not None}")
+
+        for cached, expected_calls in ((False, 2), (True, 1)):
+            with self.test_renderer(MAKO_CACHE_REQUEST_CONTEXT=cached) as (
+                    app, mako):
+                calls = []
+
+                @app.context_processor
+                def inject():
+                    calls.append(1)
+                    return {"injected": "injected", "value": "processor"}
+
+                self.assertEqual(render_template("processed"),
+                                 b"injected processor True")
+                self.assertEqual(render_template("processed", value="given",
+                                                 config=None),
+                                 b"injected given True")
+                self.assertEqual(len(calls), expected_calls)
+
+    def test_filesystem_check_interval(self):
+        """ Tests that template changes are checked at most once per
+        interval. """
+        self._add_template("changing", "before")
+        path = os.path.join(self.root, "templates", "changing")
+
+        with self.test_renderer(MAKO_FILESYSTEM_CHECK_INTERVAL=3600) as (
+                app, mako):
+            self.assertEqual(render_template("changing"), b"before")
+            self._add_template("changing", "after")
+            future = os.stat(path).st_mtime + 10
+            os.utime(path, (future, future))
+            self.assertEqual(render_template("changing"), b"before")
+
+            app._mako_lookup.check_interval = 0
+            self.assertEqual(render_template("changing"), b"after")
+
+    def test_string_cache(self):
+        """ Tests that string templates are only compiled once. """
+        with self.test_renderer() as (app, mako):
+            self.assertEqual(render_template_string(u"${x}", x=1), u"1")
+            self.assertEqual(render_template_string(u"${x}", x=2), u"2")
+            self.assertEqual(render_template_string(u"${x}!", x=3), u"3!")
+            info = mako.string_cache_info()
+            self.assertEqual(info.hits, 1)
+            self.assertEqual(info.misses, 2)
+            self.assertEqual(info.currsize, 2)
+
+        with self.test_renderer(MAKO_STRING_CACHE_SIZE=1) as (app, mako):
+            render_template_string(u"a")
+            render_template_string(u"b")
+            render_template_string(u"a")
+            info = mako.string_cache_info()
+            self.assertEqual(info.misses, 3)
+            self.assertEqual(info.currsize, 1)
+
+    def test_string_cache_compact(self):
+        """ Tests that compact string templates still translate errors. """
+        source = u"<p>${x}</p>\n" * 200 + u"${error}"
+
+        def footprint(**config):
+            with self.test_renderer(**config) as (app, mako):
+                with self.assertRaises(TemplateError) as error:
+                    render_template_string(source, x=1)
+                self.assertTrue('line 201' in error.exception.text)
+                (key, size), = mako.string_cache_footprint()
+                self.assertEqual(key, app._mako_string_cache.key_for(source))
+                return size
+
+        self.assertTrue(footprint(MAKO_STRING_CACHE_COMPACT=True) <
+                        footprint())
+
+    def test_precompile(self):
+        """ Tests that all templates can be compiled ahead of time. """
+        self._add_template("one", "1")
+        self._add_template("two", "2")
+        self._add_template("blue", "blue", "blueprint_templates")
+        module_dir = os.path.join(self.root, "modules")
+        test = Blueprint('blue', __name__,
+                         template_folder=os.path.join(self.root,
+                                                      "blueprint_templates"))
+
+        with self.test_renderer(MAKO_MODULE_DIRECTORY=module_dir) as (app,
+                                                                      mako):
+            app.register_blueprint(test)
+            compiled = mako.precompile()
+            self.assertEqual(sorted(compiled), ["blue", "one", "two"])
+            for name in compiled:
+                path = os.path.join(module_dir, name + ".py")
+                self.assertTrue(os.path.exists(path))
+                self.assertTrue(name in app._mako_lookup._collection)
+
+        with self.test_renderer(MAKO_PRECOMPILE=True) as (app, mako):
+            self.assertTrue("one" in app._mako_lookup._collection)
+
+        self._add_template("page.mako", "${x}")
+        self._add_template("jinja.html", "{% if x %}${{% endif %}")
+        with self.test_renderer(MAKO_TEMPLATE_EXTENSIONS=".mako") as (app,
+                                                                      mako):
+            summary = mako.precompile()
+            self.assertEqual(list(summary), ["page.mako"])
+            self.assertEqual(list(summary.failures), [])
+
+    def test_preload(self):
+        """ Tests loading all templates before forking workers. """
+        import gc
+        self._add_template("one", "1")
+
+        with self.test_renderer(MAKO_PRELOAD=True) as (app, mako):
+            try:
+                self.assertTrue("one" in app._mako_lookup._collection)
+                if hasattr(gc, 'freeze'):
+                    self.assertTrue(gc.get_freeze_count() > 0)
+            finally:
+                if hasattr(gc, 'unfreeze'):
+                    gc.unfreeze()
+
+    def test_precompile_parallel(self):
+        """ Tests compiling templates in worker processes. """
+        self._add_template("one", "1")
+        self._add_template("two", "${")
+        module_dir = os.path.join(self.root, "modules")
+
+        with self.test_renderer() as (app, mako):
+            with self.assertRaises(RuntimeError):
+                mako.precompile(processes=2)
+
+        with self.test_renderer(MAKO_MODULE_DIRECTORY=module_dir) as (app,
+                                                                      mako):
+            summary = mako.precompile(processes=2)
+            self.assertEqual(list(summary), ["one"])
+            self.assertEqual(list(summary.failures), ["two"])
+            self.assertTrue(os.path.exists(os.path.join(module_dir, "one.py")))
+            self.assertTrue("one" in app._mako_lookup._collection)
+            self.assertTrue("FAILED  two" in summary.report())
+
+        with self.test_renderer(MAKO_MODULE_DIRECTORY=module_dir,
+                                MAKO_PREPROCESSOR=lambda s: s) as (app, mako):
+            with self.assertRaises(RuntimeError):
+                mako.precompile(processes=2)
+
+    def test_bytecode_cache(self):
+        """ Tests sharing compiled templates through the bytecode cache. """
+        self._add_template("cached", "${x}")
+        cache_dir = os.path.join(self.root, "bytecode")
+
+        with self.test_renderer(MAKO_BYTECODE_CACHE_DIR=cache_dir) as (app,
+                                                                       mako):
+            self.assertEqual(render_template("cached", x=1), b"1")
+            entries = os.listdir(cache_dir)
+            self.assertEqual(len(entries), 1)
+
+        with self.test_renderer(MAKO_BYTECODE_CACHE_DIR=cache_dir) as (app,
+                                                                       mako):
+            self.assertEqual(render_template("cached", x=2), b"2")
+            cache = app._mako_lookup.bytecode_cache
+            self.assertTrue(cache.load(entries[0][:-len(".bin")]) is not None)
+            self.assertEqual(os.listdir(cache_dir), entries)
+
+        self._add_template("cached", "-${x}")
+        with self.test_renderer(MAKO_BYTECODE_CACHE_DIR=cache_dir) as (app,
+                                                                       mako):
+            self.assertEqual(render_template("cached", x=3), b"-3")
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            summary = mako.precompile(processes=2)
+            self.assertEqual(list(summary), ["cached"])
+
+        # preprocessors are keyed on their code, not only on their name
+        self._add_template("hello", "hello")
+        for preprocessor, output in [(lambda s: s, b"hello"),
+                                     (lambda s: s.upper(), b"HELLO")]:
+            with self.test_renderer(MAKO_BYTECODE_CACHE_DIR=cache_dir,
+                                    MAKO_PREPROCESSOR=preprocessor) as (app,
+                                                                        mako):
+                self.assertEqual(render_template("hello"), output)
+
+    def test_reload(self):
+        """ Tests rebuilding the lookup and invalidating templates. """
+        self._add_template("one", "1")
+        self._add_template("blue", "blue", "blueprint_templates")
+        test = Blueprint('blue', __name__,
+                         template_folder=os.path.join(self.root,
+                                                      "blueprint_templates"))
+
+        with self.test_renderer(MAKO_IMPORTS=["import os"],
+                                MAKO_FILESYSTEM_CHECKS=False) as (app, mako):
+            self.assertEqual(render_template("one"), b"1")
+            module = app._mako_lookup.get_template("one").module
+            app.register_blueprint(test)
+            with self.assertRaises(TopLevelLookupException):
+                render_template("blue")
+
+            lookup = mako.reload()
+            self.assertTrue(app._mako_lookup is lookup)
+            self.assertEqual(app.config['MAKO_IMPORTS'], ["import os"])
+            self.assertTrue(lookup.get_template("one").module is module)
+            self.assertTrue(lookup.get_template("one").lookup is lookup)
+            self.assertEqual(render_template("blue"), b"blue")
+
+            self._add_template("one", "2")
+            self.assertEqual(render_template("one"), b"1")
+            mako.invalidate("one")
+            self.assertEqual(render_template("one"), b"2")
+
+            self._add_template("two", "two")
+            mako.invalidate()
+            self.assertEqual(render_template("two"), b"two")
+
+    def test_single_flight_compile(self):
+        """ Tests that concurrent loads of a template compile it once. """
+        import threading, time
+        self._add_template("slow", "slow")
+
+        def preprocessor(source):
+            time.sleep(0.2)
+            return source
+
+        with self.test_renderer(MAKO_PREPROCESSOR=preprocessor) as (app,
+                                                                    mako):
+            self.assertEqual(mako.compile_info(), (0, 0))
+            lookup = app._mako_lookup
+            templates = []
+            threads = [threading.Thread(
+                target=lambda: templates.append(lookup.get_template("slow")))
+                for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(set(map(id, templates))), 1)
+            self.assertEqual(mako.compile_info(), (1, 3))
+
+    def test_collection_max_bytes(self):
+        """ Tests bounding the compiled templates by their footprint. """
+        for name in ("a", "b", "c"):
+            self._add_template(name, "${x}" * 50)
+
+        with self.test_renderer() as (app, mako):
+            render_template("a", x=1)
+            size = dict(mako.resident_templates())["a"]
+            self.assertTrue(size > 0)
+
+        with self.test_renderer(MAKO_COLLECTION_MAX_BYTES=size * 2.5) as (
+                app, mako):
+            for name in ("a", "b", "a", "c"):
+                render_template(name, x=1)
+            resident = mako.resident_templates()
+            self.assertEqual([uri for uri, _ in resident], ["c", "a"])
+            self.assertEqual(app._mako_lookup._collection.evictions, 1)
+            self.assertEqual(render_template("b", x=2), b"2" * 50)
+            self.assertEqual(app._mako_lookup.compile_info().compiled, 4)
+
+    def test_dependency_graph(self):
+        """ Tests tracking and invalidating dependent templates. """
+        self._add_template("base.html", "<%block name='b'/>|${self.body()}")
+        lib = os.path.join("templates", "lib")
+        self._add_template("defs.html", "<%def name='f()'>f</%def>", lib)
+        self._add_template("page.html", """<%inherit file="/base.html"/>
+<%namespace name="defs" file="defs.html"/>\
+<%def name="d()">${defs.f()}</%def>""", lib)
+        self._add_template("other.html", "<%include file='${name}'/>")
+        self._add_template("unused.html", "<%include file='base.html'/>")
+
+        with self.test_renderer() as (app, mako):
+            mako.cache_fragment("lib/page.html", "d", key=lambda c: 1)
+            self.assertEqual(render_template_def("lib/page.html", "d"), b"f")
+            app._mako_fragment_cache.set(("other.html", "d", 1), b"x")
+            render_template("other.html", name="lib/defs.html")
+
+            graph = mako.dependency_graph()
+            self.assertEqual(graph.as_dict(), {
+                "base.html": [],
+                "lib/defs.html": [],
+                "lib/page.html": ["base.html", "lib/defs.html"],
+                "other.html": [],
+            })
+            self.assertEqual(graph.dependents("lib/defs.html"),
+                             set(["lib/page.html"]))
+            self.assertFalse("unused.html" in graph)
+            self.assertTrue("unused.html" in mako.dependency_graph(full=True))
+
+            self.assertEqual(mako.invalidate("base.html"),
+                             set(["base.html", "lib/page.html",
+                                  "unused.html"]))
+            collection = app._mako_lookup._collection
+            self.assertFalse("lib/page.html" in collection)
+            self.assertTrue("other.html" in collection)
+            cache = app._mako_fragment_cache
+            self.assertEqual(cache.get(("lib/page.html", "d", 1)), None)
+            self.assertEqual(cache.get(("other.html", "d", 1)), b"x")
+
+        # templates loaded without being compiled aren't parsed again
+        cache_dir = os.path.join(self.root, "bytecode")
+        module_dir = os.path.join(self.root, "modules")
+        for config in [dict(MAKO_BYTECODE_CACHE_DIR=cache_dir),
+                       dict(MAKO_MODULE_DIRECTORY=module_dir)]:
+            for loaded in range(2):
+                with self.test_renderer(**config) as (app, mako):
+                    render_template_def("lib/page.html", "d")
+                    unparsed = app._mako_lookup._unparsed
+                    if loaded and "MAKO_MODULE_DIRECTORY" in config:
+                        self.assertTrue("lib/page.html" in unparsed)
+                    else:
+                        self.assertEqual(unparsed, {})
+                    self.assertEqual(
+                        mako.dependency_graph().dependencies("lib/page.html"),
+                        set(["base.html", "lib/defs.html"]))
+                    self.assertEqual(app._mako_lookup._unparsed, {})
+
+    def test_precompile_command(self):
+        """ Tests the `flask mako compile` command. """
+        from click.testing import CliRunner
+        from flask.cli import ScriptInfo
+
+        self._add_template("one", "1")
+        with self.test_renderer() as (app, mako):
+            runner = CliRunner()
+            result = runner.invoke(app.cli, ['mako', 'compile'],
+                                   obj=ScriptInfo(create_app=lambda i: app))
+            self.assertEqual(result.exit_code, 0)
+            self.assertTrue('Compiled 1 templates' in result.output)
+
+            result = runner.invoke(app.cli, ['mako', 'compile', '-j', '2'],
+                                   obj=ScriptInfo(create_app=lambda i: app))
+            self.assertEqual(result.exit_code, 1)
+            self.assertTrue('MAKO_MODULE_DIRECTORY' in result.output)
+
+    def test_render_template_response(self):
+        """ Tests responses answering conditional requests. """
+        self._add_template("etag", """<%def name="d()">def ${x}</%def>\
+${x()}""")
+
+        with self.test_renderer() as (app, mako):
+            response = render_template_response("etag", key=1, max_age=60,
+                                                x=lambda: "page")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_data(), b"page")
+            self.assertEqual(response.cache_control.max_age, 60)
+            etag = response.get_etag()[0]
+
+            def fail():
+                raise AssertionError("rendered")
+            headers = {'If-None-Match': '"%s"' % etag}
+            with app.test_request_context(headers=headers):
+                response = render_template_response("etag", key=1, x=fail)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.get_data(), b"")
+
+                response = render_template_response("etag", key=2,
+                                                    x=lambda: "new")
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.get_etag()[0], etag)
+
+            response = render_template_response("etag", def_name="d", x=1)
+            self.assertEqual(response.get_data(), b"def 1")
+            headers = {'If-None-Match': response.headers['ETag']}
+            with app.test_request_context(headers=headers):
+                response = render_template_response("etag", def_name="d",
+                                                    x=1)
+                self.assertEqual(response.status_code, 304)
+
+    def test_template_response_versions(self):
+        """ Tests that keyed ETags depend on the template sources only. """
+        self._add_template("layout.html", "<%include file='nav.html'/>"
+                                          "${next.body()}")
+        self._add_template("nav.html", "nav")
+        self._add_template("child.html", "<%inherit file='layout.html'/>child")
+
+        etags = []
+        for i in range(2):
+            with self.test_renderer() as (app, mako):
+                response = render_template_response("child.html", key=1)
+                self.assertEqual(response.get_data(), b"navchild")
+                etags.append(response.get_etag()[0])
+        self.assertEqual(etags[0], etags[1])
+
+        with self.test_renderer() as (app, mako):
+            render_template_response("child.html", key=1)
+            for name, text in [("layout.html", "<%include file='nav.html'/>"
+                                               "[${next.body()}]"),
+                               ("nav.html", "menu")]:
+                self._add_template(name, text)
+                # newer than the compiled template, as far as Mako can tell
+                mtime = time.time() + 10
+                os.utime(os.path.join(self.root, "templates", name),
+                         (mtime, mtime))
+                headers = {'If-None-Match': '"%s"' % etags[-1]}
+                with app.test_request_context(headers=headers):
+                    response = render_template_response("child.html", key=1)
+                    self.assertEqual(response.status_code, 200)
+                    etags.append(response.get_etag()[0])
+            self.assertEqual(response.get_data(), b"menu[child]")
+            self.assertEqual(len(set(etags)), 3)
+
+    def test_buffer_strategies(self):
+        """ Tests rendering with every output buffer strategy. """
+        self._add_template("buffered", u"""<%def name="d()">\xA2${x}</%def>\
+<%def name="upper()"><% return caller.body().upper() %></%def>\
+${d()} ${capture(d)} <%self:upper>${x}</%self:upper>""")
+        expected = u"\xA21 \xA21 1".encode('utf-8')
+
+        for strategy in ('list', 'stringio', 'bytes'):
+            with self.test_renderer(MAKO_BUFFER_STRATEGY=strategy) as _:
+                self.assertEqual(render_template("buffered", x=1), expected)
+                self.assertEqual(render_template_def("buffered", "d", x=2),
+                                 u"\xA22".encode('utf-8'))
+
+        with self.test_renderer(MAKO_OUTPUT_ENCODING=None) as _:
+            with buffer_strategy('stringio'):
+                self.assertEqual(render_template("buffered", x=1),
+                                 expected.decode('utf-8'))
+            with buffer_strategy('bytes'):
+                with self.assertRaises(ValueError):
+                    render_template("buffered", x=1)
+            with self.assertRaises(ValueError):
+                buffer_strategy('unknown').__enter__()
+
+    def test_render_text(self):
+        """ Tests rendering text whatever the output encoding. """
+        self._add_template("text", u"""<%def name="d()">\xA2${x}</%def>\
+${d()}""")
+
+        with self.test_renderer() as (app, mako):
+            self.assertEqual(render_template_text("text", x=1), u"\xA21")
+            self.assertEqual(render_template("text", x=1),
+                             u"\xA21".encode('utf-8'))
+
+            mako.cache_fragment("text", "d", key=lambda c: c['x'])
+            self.assertEqual(render_template_def("text", "d", x=2),
+                             u"\xA22".encode('utf-8'))
+            self.assertEqual(render_template_def_text("text", "d", x=2),
+                             u"\xA22")
+            mako.invalidate_fragment("text", "d", x=2)
+            cache = app._mako_fragment_cache
+            self.assertEqual(cache.get(("text", "d", 2)), None)
+            self.assertEqual(cache.get(("text", "d", (2, "text"))), None)
+
+            with buffer_strategy('bytes'):
+                self.assertEqual(render_template_text("text", x=3), u"\xA23")
+
+    def test_response_encoding(self):
+        """ Tests that responses are sent with the output encoding. """
+        self._add_template("text", u"\xA2${x}")
+
+        with self.test_renderer(MAKO_OUTPUT_ENCODING="latin-1") as _:
+            response = render_template_response("text", x=1)
+            self.assertEqual(response.get_data(), b"\xA21")
+            self.assertEqual(response.mimetype_params['charset'], "latin-1")
+
+        with self.test_renderer(MAKO_OUTPUT_ENCODING=None) as _:
+            response = render_template_response("text", x=1)
+            self.assertEqual(response.get_data(), u"\xA21".encode('utf-8'))
+            self.assertEqual(response.mimetype_params['charset'], "utf-8")
+
+    def test_render_many(self):
+        """ Tests rendering a template or def for many contexts at once. """
+        self._add_template("many", """<%def name="row(item)">\
+${prefix}${item}</%def>${prefix}${item}""")
+
+        with self.test_renderer() as (app, mako):
+            contexts = [{'item': i} for i in range(3)]
+            self.assertEqual(render_template_many("many", contexts,
+                                                  prefix="t"),
+                             [b"t0", b"t1", b"t2"])
+            self.assertEqual(render_template_def_many("many", "row", contexts,
+                                                      prefix="d"),
+                             [b"d0", b"d1", b"d2"])
+            self.assertEqual(render_template_def_many(
+                "many", "row", [{'item': 1, 'prefix': 'own'}], prefix="d"),
+                [b"own1"])
+
+            with self.assertRaises(TemplateError):
+                render_template_many("many", [{'item': 1}])
+
+    @unittest.skipIf(sys.version_info < (3, 5),
+                     "This test requires asyncio.")
+    def test_async(self):
+        """ Tests the awaitable render functions. """
+        import asyncio
+        import flask_mako
+        self._add_template("async", """<%def name="d()">def</%def>\
+${x} ${url_for('test')}""")
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        run = loop.run_until_complete
+
+        with self.test_renderer(MAKO_STREAM_BUFFER_SIZE=1) as (app, mako):
+            @app.route('/test')
+            def test(): return "test"
+
+            self.assertEqual(run(flask_mako.render_template_async(
+                "async", x=1)), b"1 /test")
+            self.assertEqual(run(flask_mako.render_template_string_async(
+                u"${x}", x=2)), u"2")
+            self.assertEqual(run(flask_mako.render_template_def_async(
+                "async", "d")), b"def")
+
+            stream = flask_mako.stream_template_async("async", x=3)
+            chunks = []
+            while True:
+                try:
+                    chunks.append(run(stream.__anext__()))
+                except StopAsyncIteration:
+                    break
+            self.assertTrue(len(chunks) > 1)
+            self.assertEqual(b"".join(chunks), b"3 /test")
+
+            with self.assertRaises(TemplateError):
+                run(flask_mako.render_template_async("async"))
+
+    def test_stream_template(self):
+        """ Tests that templates can be rendered in chunks. """
+        self._add_template("stream", """<%def name="item(i)">${i},</%def>
+% for i in range(10):
+${item(i)}
+% if i == 2:
+<% flush() %>
+% endif
+% endfor
+${url_for('test')}""")
+
+        with self.test_renderer(MAKO_STREAM_BUFFER_SIZE=10) as (app, mako):
+            @app.route('/test')
+            def test(): return "test"
+
+            chunks = list(stream_template("stream"))
+            self.assertEqual(chunks[0], b"\n0,\n1,\n2,\n")
+            self.assertTrue(len(chunks) > 2)
+            self.assertTrue(b"".join(chunks).endswith(b"8,\n9,\n/test"))
+
+            chunks = list(stream_template_def("stream", "item", i=3))
+            self.assertEqual(chunks, [b"3,"])
+
+    def test_stream_template_error(self):
+        """ Tests that errors of streamed templates are translated. """
+        self._add_template("stream_error", "ok ${error}")
+
+        with self.test_renderer(MAKO_STREAM_BUFFER_SIZE=1) as (app, mako):
+            chunks = stream_template("stream_error")
+            self.assertEqual(next(chunks), b"ok ")
+            with self.assertRaises(TemplateError):
+                next(chunks)
+
+    def test_fragment_cache(self):
+        """ Tests that def outputs can be cached. """
+        self._add_template("frag", """
+        <%def name="row(item)">${item['name']}</%def>
+        <%def name="other()">other</%def>
+        """)
+
+        for backend in ('memory', 'filesystem'):
+            with self.test_renderer(MAKO_FRAGMENT_CACHE=backend,
+                                    MAKO_FRAGMENT_CACHE_DIR=os.path.join(
+                                        self.root, "fragments")) as (app,
+                                                                     mako):
+                mako.cache_fragment("frag", "row",
+                                    key=lambda context: context['item']['id'])
+                item = {'id': 1, 'name': 'one'}
+                self.assertEqual(render_template_def("frag", "row", item=item),
+                                 b"one")
+
+                item['name'] = 'changed'
+                self.assertEqual(render_template_def("frag", "row", item=item),
+                                 b"one")
+                self.assertEqual(render_template_def(
+                    "frag", "row", item={'id': 2, 'name': 'two'}), b"two")
+
+                mako.invalidate_fragment("frag", "row", app=app, item=item)
+                self.assertEqual(render_template_def("frag", "row", item=item),
+                                 b"changed")
+
+                item['name'] = 'again'
+                mako.clear_fragments("frag")
+                self.assertEqual(render_template_def("frag", "row", item=item),
+                                 b"again")
+
+    def test_fragment_cache_file_change(self):
+        """ Tests that cached def outputs are dropped when a template file
+        changes, even if the def is only served from the cache. """
+        self._add_template("frag.html", "<%def name='d()'>old</%def>")
+        self._add_template("parts.html", "<%def name='p()'>part</%def>")
+        self._add_template("uses.html", "<%namespace name='parts' "
+                                        "file='parts.html'/>"
+                                        "<%def name='d()'>${parts.p()}</%def>")
+
+        def rewrite(name, text):
+            self._add_template(name, text)
+            # newer than the compiled template, as far as Mako can tell
+            mtime = time.time() + 10
+            os.utime(os.path.join(self.root, "templates", name),
+                     (mtime, mtime))
+
+        with self.test_renderer() as (app, mako):
+            for name in ("frag.html", "uses.html"):
+                mako.cache_fragment(name, "d", key=lambda context: 1)
+            self.assertEqual(render_template_def("frag.html", "d"), b"old")
+            self.assertEqual(render_template_def("uses.html", "d"), b"part")
+
+            rewrite("frag.html", "<%def name='d()'>new</%def>")
+            self.assertEqual(render_template_def("frag.html", "d"), b"new")
+            rewrite("parts.html", "<%def name='p()'>changed</%def>")
+            self.assertEqual(render_template_def("uses.html", "d"),
+                             b"changed")
+
+    def test_fragment_cache_timeout(self):
+        """ Tests that cached def outputs expire. """
+        self._add_template("frag", """<%def name="now()">${time()}</%def>""")
+
+        with self.test_renderer() as (app, mako):
+            import time
+            mako.cache_fragment("frag", "now", key=lambda context: None,
+                                timeout=0.01)
+            first = render_template_def("frag", "now", time=time.time)
+            self.assertEqual(render_template_def("frag", "now",
+                                                 time=time.time), first)
+            time.sleep(0.02)
+            self.assertNotEqual(render_template_def("frag", "now",
+                                                    time=time.time), first)
+
     def test_imports(self):
         """ Tests that the extension properly sets Mako imports. """
         from string import ascii_letters
@@ -222,6 +851,111 @@ class MakoDetailedTestCase(unittest.TestCase):
 
             self.assertEqual(len(log), 1)
 
+    def test_stats(self):
+        """ Tests that render statistics are collected when enabled. """
+        self._add_template("stats", """<%def name="d()">def</%def>page""")
+
+        with self.test_renderer() as (app, mako):
+            render_template("stats")
+            self.assertEqual(mako.stats(), None)
+
+        with self.test_renderer(MAKO_COLLECT_STATS=True) as (app, mako):
+            render_template("stats")
+            render_template("stats")
+            render_template_def("stats", "d")
+            render_template_string(u"${1}")
+            render_template_string(u"${1}")
+
+            stats = mako.stats().get("stats")
+            self.assertEqual(stats.renders, 2)
+            self.assertEqual(stats.output_size, 8)
+            self.assertEqual(stats.compiles, 1)
+            self.assertTrue(stats.percentile(99) >= stats.percentile(50) > 0)
+            self.assertEqual(mako.stats().get("stats", "d").renders, 1)
+
+            key = app._mako_string_cache.key_for(u"${1}")
+            string_stats = mako.stats().get("string:" + key)
+            self.assertEqual(string_stats.compiles, 1)
+            self.assertEqual(string_stats.cache_hits, 1)
+            self.assertEqual(len(mako.stats().snapshot()), 3)
+
+        with self.test_renderer(MAKO_COLLECT_STATS=True,
+                                MAKO_STATS_MAX_ENTRIES=5,
+                                MAKO_STRING_CACHE_SIZE=2) as (app, mako):
+            render_template("stats")
+            for i in range(20):
+                render_template_string(u"${%d}" % i)
+            render_template_string(u"${19}")
+            self.assertEqual(len(mako.stats()), 5)
+            self.assertEqual(mako.stats().get("stats"), None)
+            key = app._mako_string_cache.key_for(u"${19}")
+            self.assertEqual(mako.stats().get("string:" + key).renders, 2)
+
+    @unittest.skipIf(not flask.signals_available,
+                     "This test requires Flask signaling support.")
+    def test_render_signals(self):
+        """ Tests the before_render and after_render signals. """
+        from flask_mako import before_render, after_render
+
+        self._add_template("signal", "signal template")
+        with self.test_renderer() as (app, mako):
+            log = []
+            def before(sender, template, context):
+                log.append(('before', template.uri))
+            def after(sender, template, context, duration):
+                log.append(('after', template.uri, duration >= 0))
+            before_render.connect(before, app)
+            after_render.connect(after, app)
+
+            render_template('signal')
+            self.assertEqual(log, [('before', 'signal'),
+                                   ('after', 'signal', True)])
+
+    def test_profiler(self):
+        """ Tests attributing render time to defs and template lines. """
+        import time
+        self._add_template("profiled", """<%def name="row(i)">
+${slow(i)}
+</%def>
+% for i in range(3):
+${row(i)}
+% endfor
+""")
+
+        with self.test_renderer(MAKO_PROFILE=True) as (app, mako):
+            render_template("profiled", slow=lambda i: time.sleep(0.01))
+            profiler = mako.profiler()
+            self.assertEqual(profiler.renders, 1)
+            self.assertEqual(profiler.defs()[0][0], ("profiled", "row"))
+            self.assertEqual(profiler.lines()[0][0], ("profiled", "row", 2))
+            self.assertTrue("profiled:2 (row)  ${slow(i)}" in
+                            profiler.report())
+            folded = dict(line.rsplit(" ", 1)
+                          for line in profiler.folded().splitlines())
+            self.assertTrue(int(folded["profiled:body:5;profiled:row:2"]) >=
+                            30000)
+
+        with self.test_renderer(MAKO_PROFILE=True,
+                                MAKO_PROFILE_SAMPLE_RATE=2) as (app, mako):
+            for _ in range(4):
+                render_template("profiled", slow=lambda i: None)
+            self.assertEqual(mako.profiler().renders, 2)
+
+    def test_signal_sample_rate(self):
+        """ Tests sending the signals for one render in N. """
+        from flask.signals import template_rendered
+
+        self._add_template("signal", "signal template")
+        with self.test_renderer(MAKO_SIGNAL_SAMPLE_RATE=3) as (app, mako):
+            log = []
+            def rendered(sender, template, context):
+                log.append(template.uri)
+            template_rendered.connect(rendered, app)
+
+            for _ in range(6):
+                render_template('signal')
+            self.assertEqual(log, ['signal', 'signal'])
+
     def test_multiple_apps(self):
         """ Tests that the Mako plugin works with multiple Flask apps. """
         self._add_template("app", "test 1", "alt1")
@@ -252,6 +986,48 @@ class MakoDetailedTestCase(unittest.TestCase):
 
             self.assertEqual(render_template("blue"), b"blueprint")
 
+    def test_template_index(self):
+        """ Tests that templates are found through the index, and that
+        shadowed templates are reported. """
+        self._add_template("index", "app")
+        self._add_template("index", "blueprint", "blueprint_templates")
+        self._add_template("only_blue", "blue", "blueprint_templates")
+        blue_dir = os.path.join(self.root, "blueprint_templates")
+        test = Blueprint('blue', __name__, template_folder=blue_dir)
+
+        with self.test_renderer(MAKO_FILESYSTEM_CHECKS=False) as (app, mako):
+            app.register_blueprint(test)
+            self.assertEqual(render_template("index"), b"app")
+            self.assertEqual(render_template("/only_blue"), b"blue")
+            self.assertEqual(mako.shadowed_templates(), {
+                "index": [os.path.join(self.root, "templates", "index"),
+                          os.path.join(blue_dir, "index")]})
+
+            self._add_template("new", "new")
+            with self.assertRaises(TopLevelLookupException):
+                render_template("new")
+
+        with self.test_renderer() as (app, mako):
+            app.register_blueprint(test)
+            render_template("index")
+            self._add_template("new", "new")
+            self.assertEqual(render_template("new"), b"new")
+            # a template added to the app folder overrides the blueprint's
+            self._add_template("shadow", "blue", "blueprint_templates")
+            self._add_template("shadow", "app")
+            self.assertEqual(render_template("shadow"), b"app")
+            self.assertTrue("shadow" in mako.shadowed_templates())
+            # even when the blueprint's was indexed first
+            self._add_template("only_blue", "app")
+            self.assertEqual(render_template("only_blue"), b"app")
+
+        # templates in symlinked folders are indexed
+        if hasattr(os, 'symlink'):
+            os.symlink(blue_dir, os.path.join(self.root, "templates", "inc"))
+            with self.test_renderer(MAKO_FILESYSTEM_CHECKS=False) as (app,
+                                                                      mako):
+                self.assertEqual(render_template("inc/only_blue"), b"blue")
+
     def test_error(self):
         """ Tests that template errors are properly handled. """
         self._add_template("error_template", """
@@ -273,6 +1049,42 @@ class MakoDetailedTestCase(unittest.TestCase):
             with self.assertRaises(NameError):
                 render_template('error_template', arguments=['y'])
 
+    def test_error_lazy(self):
+        """ Tests that template errors are only translated when needed. """
+        self._add_template("error_template", "\n${error}")
+
+        with self.test_renderer() as (app, mako):
+            with self.assertRaises(TemplateError) as error:
+                render_template('error_template')
+            e = error.exception
+            self.assertFalse('records' in e.__dict__)
+            self.assertFalse('text' in e.__dict__)
+            self.assertEqual([r[5] for r in e.records if r[4]], [2])
+            self.assertTrue('line 2' in e.text)
+
+    def test_error_summary(self):
+        """ Tests that repeated errors share their translated text. """
+        self._add_template("error_template", "${error}")
+        self._add_template("other_error", "${other}")
+
+        with self.test_renderer() as (app, mako):
+            self.assertEqual(mako.error_summary(), None)
+
+        with self.test_renderer(MAKO_ERROR_SUMMARY_INTERVAL=60) as (app,
+                                                                   mako):
+            errors = []
+            for name in ('error_template', 'error_template', 'other_error'):
+                try:
+                    render_template(name)
+                except TemplateError as e:
+                    errors.append(e)
+            first, second, other = errors
+            self.assertEqual([e.repeated for e in errors], [0, 1, 0])
+            self.assertTrue(first.text is second.text)
+            self.assertFalse(other.text is first.text)
+            summaries = mako.error_summary().summaries()
+            self.assertEqual([count for key, count in summaries], [2, 1])
+
 try:
     from flaskext import babel
     from flaskext.babel import Babel